@@ -0,0 +1,61 @@
+'''
+Compares the tiled chamfer distance of the shape-match loss against the dense version it replaced,
+which repeats both point clouds into batch x N x N x 3 tensors. Reports the time of a forward and
+backward pass, and the size of the largest distance tensor (or the peak allocated memory on cuda).
+'''
+from unsupervised_rbt.losses.shapematch import chamfer_distance
+import torch
+import time
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-batch_size', type=int, default=64)
+    parser.add_argument('-num_points', type=int, default=1000)
+    parser.add_argument('-tile_sizes', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('-num_iters', type=int, default=5)
+    parser.add_argument('-device', type=str, default='cpu')
+    parser.add_argument('-skip_dense', action='store_true', help='skip the dense version, e.g. if it does not fit in memory')
+    args = parser.parse_args()
+    return args
+
+def dense_chamfer_distance(x, y):
+    """The chamfer distance as previously computed by ShapeMatchLoss.PointCloudDistance."""
+    x_size, y_size = x.size(), y.size()
+    x = torch.unsqueeze(x, 1).repeat(1, y_size[1], 1, 1)  # x = batch,m,n,3
+    y = torch.unsqueeze(y, 2).repeat(1, 1, x_size[1], 1)  # y = batch,m,n,3
+    x_y = torch.sum(torch.pow(x - y, 2), 3)  # x_y = batch,m,n
+    x_y_row, _ = torch.min(x_y, 1)  # x_y_row = batch,n
+    return torch.mean(torch.mean(x_y_row, 1))
+
+def benchmark(distance_fn, x, y, num_iters):
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+    start_time = time.time()
+    for _ in range(num_iters):
+        loss = distance_fn(x, y)
+        loss.backward()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    peak_mb = torch.cuda.max_memory_allocated() / 1e6 if x.is_cuda else float('nan')
+    return loss.item(), (time.time() - start_time) / num_iters, peak_mb
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device(args.device)
+    B, N = args.batch_size, args.num_points
+    x = torch.randn(B, N, 3, device=device, requires_grad=True)
+    y = torch.randn(B, N, 3, device=device, requires_grad=True)
+
+    options = [] if args.skip_dense else [("dense", N, dense_chamfer_distance)]
+    for tile_size in args.tile_sizes:
+        options.append(("tile %d" % tile_size, tile_size,
+                        lambda x, y, tile_size=tile_size: chamfer_distance(x, y, tile_size)))
+
+    print("Benchmarking batch size", B, "with", N, "points on", device)
+    print("%-10s %12s %14s %18s %14s" % ("version", "loss", "ms/step", "distance tensor MB", "peak MB"))
+    for name, tile_size, distance_fn in options:
+        loss, step_time, peak_mb = benchmark(distance_fn, x, y, args.num_iters)
+        tensor_mb = B * N * min(tile_size, N) * 3 * 4 / 1e6
+        print("%-10s %12.6f %14.1f %18.1f %14.1f" % (name, loss, 1000 * step_time, tensor_mb, peak_mb))
@@ -0,0 +1,85 @@
+'''
+Compares the storage options for the depth images of a tensor dataset. The first datapoints of the
+dataset are written with each option, then the bytes per datapoint on disk and the read throughput
+of random batches (through get_item_list, starting from an empty cache) are reported.
+'''
+from unsupervised_rbt import TensorDataset
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+import argparse
+
+DEPTH_FIELDS = ["depth_image1", "depth_image2"]
+STORAGE_OPTIONS = [
+    # name, format, extra field config
+    ("float32 npz", "npz", {}),
+    ("float32 npy", "npy", {}),
+    ("uint16 npz", "npz", {"storage_dtype": "uint16", "scale": 65535}),
+    ("float32 bbox", "npz", {"codec": "bbox"}),
+    ("uint16 bbox", "npz", {"storage_dtype": "uint16", "scale": 65535, "codec": "bbox"}),
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dataset', type=str, default='872objv3')
+    parser.add_argument('-num_datapoints', type=int, default=4096)
+    parser.add_argument('-batch_size', type=int, default=64)
+    args = parser.parse_args()
+    return args
+
+def dataset_config(dataset, tensor_format, field_options):
+    fields = {}
+    for field_name in DEPTH_FIELDS:
+        fields[field_name] = {"dtype": "float32"}
+        for key in ["height", "width", "channels"]:
+            if key in dataset.config['fields'][field_name].keys():
+                fields[field_name][key] = dataset.config['fields'][field_name][key]
+        fields[field_name].update(field_options)
+    return {"datapoints_per_file": dataset.datapoints_per_file, "format": tensor_format, "fields": fields}
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, filename)) for filename in os.listdir(path))
+
+def benchmark(images, config, batch_size, dataset_dir):
+    num_datapoints = images[DEPTH_FIELDS[0]].shape[0]
+    start_time = time.time()
+    dataset = TensorDataset(dataset_dir, config)
+    for i in range(num_datapoints):
+        datapoint = dataset.datapoint_template
+        for field_name in DEPTH_FIELDS:
+            datapoint[field_name] = images[field_name][i]
+        dataset.add(datapoint)
+    dataset.flush()
+    write_time = time.time() - start_time
+    bytes_per_datapoint = directory_size(dataset.tensor_dir) / float(num_datapoints)
+
+    dataset = TensorDataset.open(dataset_dir)
+    indices = np.random.permutation(num_datapoints)
+    start_time = time.time()
+    for i in range(0, num_datapoints, batch_size):
+        dataset.get_item_list(indices[i:i+batch_size], field_names=DEPTH_FIELDS)
+    read_time = time.time() - start_time
+    return bytes_per_datapoint, num_datapoints / write_time, num_datapoints / read_time
+
+if __name__ == "__main__":
+    args = parse_args()
+    dataset_root_path = "/nfs/diskstation/projects/unsupervised_rbt/"
+    dataset = TensorDataset.open(os.path.join(dataset_root_path, args.dataset))
+    num_datapoints = min(args.num_datapoints, dataset.num_datapoints)
+    images = dataset.datapoints(np.arange(num_datapoints), field_names=DEPTH_FIELDS)
+    nonzero = np.mean([np.mean(images[field_name] != 0) for field_name in DEPTH_FIELDS])
+    print("Benchmarking", num_datapoints, "datapoints,", round(100 * nonzero, 1), "% nonzero pixels")
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print("%-14s %16s %14s %14s" % ("storage", "bytes/datapoint", "writes/sec", "reads/sec"))
+        for name, tensor_format, field_options in STORAGE_OPTIONS:
+            config = dataset_config(dataset, tensor_format, field_options)
+            dataset_dir = os.path.join(temp_dir, name.replace(" ", "_"))
+            bytes_per_datapoint, write_rate, read_rate = benchmark(images, config, args.batch_size, dataset_dir)
+            print("%-14s %16d %14.1f %14.1f" % (name, bytes_per_datapoint, write_rate, read_rate))
+            shutil.rmtree(dataset_dir)
+    finally:
+        shutil.rmtree(temp_dir)
@@ -1,5 +1,6 @@
 #include <torch/torch.h>
 
+#ifdef WITH_CUDA
 // CUDA forward declarations
 int ChamferDistanceKernelLauncher(
     const int b, const int n,
@@ -54,6 +55,7 @@ void chamfer_distance_backward_cuda(
                                            graddist2.data<float>(), idx2.data<int>(),
                                            gradxyz1.data<float>(), gradxyz2.data<float>());
 }
+#endif
 
 
 void nnsearch(
@@ -179,7 +181,9 @@ void chamfer_distance_backward(
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
     m.def("forward", &chamfer_distance_forward, "ChamferDistance forward");
-    m.def("forward_cuda", &chamfer_distance_forward_cuda, "ChamferDistance forward (CUDA)");
     m.def("backward", &chamfer_distance_backward, "ChamferDistance backward");
+#ifdef WITH_CUDA
+    m.def("forward_cuda", &chamfer_distance_forward_cuda, "ChamferDistance forward (CUDA)");
     m.def("backward_cuda", &chamfer_distance_backward_cuda, "ChamferDistance backward (CUDA)");
+#endif
 }
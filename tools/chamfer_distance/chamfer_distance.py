@@ -1,13 +1,40 @@
+import os
+import logging
 import torch
 
-from torch.utils.cpp_extension import load
-cd = load(name="cd",
-          sources=["tools/chamfer_distance/chamfer_distance.cpp",
-                   "tools/chamfer_distance/chamfer_distance.cu"])
+from unsupervised_rbt.losses.shapematch import nearest_indices
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# compiled extensions by device type, built on first use (None if the build failed)
+_extensions = {}
+
+def load_extension(cuda=False):
+    """Returns the compiled extension for cpu or cuda tensors, or None if it cannot be built.
+    The extension is only compiled the first time it is needed, and torch caches the build
+    in TORCH_EXTENSIONS_DIR, so later processes load it without compiling again.
+    The cpu build only needs a C++ compiler, the cuda build also needs nvcc."""
+    if cuda not in _extensions:
+        from torch.utils.cpp_extension import load, CUDA_HOME
+        sources = [os.path.join(SOURCE_DIR, "chamfer_distance.cpp")]
+        extra_cflags = []
+        if cuda:
+            sources.append(os.path.join(SOURCE_DIR, "chamfer_distance.cu"))
+            extra_cflags.append("-DWITH_CUDA")
+        try:
+            if cuda and CUDA_HOME is None:
+                raise RuntimeError("CUDA_HOME not found")
+            _extensions[cuda] = load(name="cd_cuda" if cuda else "cd_cpu", sources=sources,
+                                     extra_cflags=extra_cflags)
+        except Exception as e:
+            logging.warning("Could not build the chamfer distance extension (%s), using the PyTorch version" %(e))
+            _extensions[cuda] = None
+    return _extensions[cuda]
 
 class ChamferDistanceFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, xyz1, xyz2):
+        cd = load_extension(xyz1.is_cuda)
         batchsize, n, _ = xyz1.size()
         _, m, _ = xyz2.size()
         xyz1 = xyz1.contiguous()
@@ -33,6 +60,7 @@ class ChamferDistanceFunction(torch.autograd.Function):
 
     @staticmethod
     def backward(ctx, graddist1, graddist2):
+        cd = load_extension(graddist1.is_cuda)
         xyz1, xyz2, idx1, idx2 = ctx.saved_tensors
 
         graddist1 = graddist1.contiguous()
@@ -50,7 +78,23 @@ class ChamferDistanceFunction(torch.autograd.Function):
 
         return gradxyz1, gradxyz2
 
+def nearest_distances(xyz1, xyz2):
+    """Squared distance from each point of xyz1 = (batch,n,3) to its closest point in xyz2 = (batch,m,3),
+    as a (batch,n) tensor. Computed in tiles with PyTorch ops, so autograd gives the same gradients
+    as the compiled extension."""
+    indices = nearest_indices(xyz1, xyz2)
+    nearest = torch.gather(xyz2, 1, torch.unsqueeze(indices, 2).expand(-1, -1, xyz2.size(2)))
+    return torch.sum(torch.pow(xyz1 - nearest, 2), 2)
 
 class ChamferDistance(torch.nn.Module):
+    """Returns the squared distances from each point of xyz1 to its closest point in xyz2 and
+    the other way around. Uses the compiled extension if it can be built, otherwise (or if
+    use_extension is False) the PyTorch version, which runs on any device without compiling."""
+    def __init__(self, use_extension=True):
+        super(ChamferDistance, self).__init__()
+        self.use_extension = use_extension
+
     def forward(self, xyz1, xyz2):
-        return ChamferDistanceFunction.apply(xyz1, xyz2)
+        if self.use_extension and xyz1.dtype == torch.float32 and load_extension(xyz1.is_cuda) is not None:
+            return ChamferDistanceFunction.apply(xyz1, xyz2)
+        return nearest_distances(xyz1, xyz2), nearest_distances(xyz2, xyz1)
@@ -0,0 +1,40 @@
+'''
+Converts a tensor dataset to another on-disk format. Converting to the raw npy format
+lets training read single datapoints through memory maps instead of inflating whole chunks.
+Converting to hdf5 packs the dataset into a single chunked file, which needs far fewer file
+opens on network storage and can be read with HDF5TensorDataset. An input dataset ending in
+.h5 is converted back to a tensor dataset in the npy or npz format.
+'''
+from unsupervised_rbt import TensorDataset, export_hdf5, import_hdf5
+import os
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-input_dataset', type=str, required=True)
+    parser.add_argument('-output_dataset', type=str, required=True)
+    parser.add_argument('-format', type=str, default='npy', choices=['npy', 'npz', 'hdf5'])
+    parser.add_argument('-chunk_datapoints', type=int, default=None,
+                        help='datapoints per hdf5 chunk (default: datapoints per file of the input)')
+    parser.add_argument('-compression', type=str, default='gzip', choices=['gzip', 'lzf', 'none'])
+    parser.add_argument('-compression_level', type=int, default=4, help='gzip level for hdf5')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    dataset_root_path = "/nfs/diskstation/projects/unsupervised_rbt/"
+    input_path = os.path.join(dataset_root_path, args.input_dataset)
+    output_path = os.path.join(dataset_root_path, args.output_dataset)
+    if args.format == 'hdf5':
+        compression = None if args.compression == 'none' else args.compression
+        dataset = TensorDataset.open(input_path)
+        export_hdf5(dataset, output_path, chunk_datapoints=args.chunk_datapoints,
+                    compression=compression, compression_opts=args.compression_level)
+        print("Exported", dataset.num_datapoints, "datapoints to", output_path)
+    elif input_path.endswith('.h5'):
+        dataset = import_hdf5(input_path, output_path, tensor_format=args.format)
+        print("Imported", dataset.num_datapoints, "datapoints to", dataset.tensor_format, "format")
+    else:
+        dataset = TensorDataset.convert(input_path, output_path, tensor_format=args.format)
+        print("Converted", dataset.num_datapoints, "datapoints to", dataset.tensor_format, "format")
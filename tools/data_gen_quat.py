@@ -2,7 +2,8 @@
 This script generates data for the self-supervised rotation prediction task
 '''
 
-from autolab_core import YamlConfig, RigidTransform, TensorDataset
+from autolab_core import YamlConfig, RigidTransform
+from autolab_core.constants import READ_WRITE_ACCESS
 from scipy.spatial.transform import Rotation
 import os
 import time
@@ -13,8 +14,10 @@ os.environ["PYOPENGL_PLATFORM"] = 'egl'
 import numpy as np
 import trimesh
 import itertools
+import shutil
 import sys
 import argparse
+import multiprocessing
 import pyrender
 from pyrender import (Scene, IntrinsicsCamera, Mesh,
                       Viewer, OffscreenRenderer, RenderFlags, Node)
@@ -25,11 +28,16 @@ import random
 from termcolor import colored
 import pickle
 from tools.utils import *
+from unsupervised_rbt import TensorDataset
+
+PROGRESS_FILENAME = "generation_progress.pkl"
 
 def parse_args():
     """Parse arguments from the command line.
     -dataset to input a name for your dataset. Should start with quaternion
     -config to input your own yaml config file. Default is cfg/tools/data_gen_quat.yaml
+    -num_workers to render objects in parallel processes, each writing its own shard that is merged at the end
+    Rerunning an interrupted run with the same arguments continues after the last completed object.
     """
     parser = argparse.ArgumentParser()
     default_config_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -37,21 +45,91 @@ def parse_args():
                                            'cfg/tools/data_gen_quat.yaml')
     parser.add_argument('-dataset', type=str, required=True)
     parser.add_argument('-config', type=str, default=default_config_filename)
+    parser.add_argument('-num_workers', type=int, default=1)
     args = parser.parse_args()
     return args
 
-if __name__ == "__main__":
-    args = parse_args()
-    config = YamlConfig(args.config)
-    # to adjust
-    name_gen_dataset = args.dataset
-    if config['debug']:
-        name_gen_dataset += "_junk"
+def progress_filename(dataset_dir):
+    return os.path.join(dataset_dir, PROGRESS_FILENAME)
+
+def load_progress(dataset_dir):
+    """Returns the progress saved by an interrupted run into dataset_dir, or None if there is none."""
+    if not os.path.exists(progress_filename(dataset_dir)):
+        return None
+    return pickle.load(open(progress_filename(dataset_dir), "rb"))
+
+def get_progress(obj_id, num_datapoints, objects_added, done=False):
+    """Returns the progress after all objects up to obj_id have been added to the dataset, along with the
+    random states, so that a restarted run continues from there. done marks a completed dataset.
+    """
+    return {
+        "obj_id": obj_id,
+        "num_datapoints": num_datapoints,
+        "objects_added": list(objects_added.keys()),
+        "np_random_state": np.random.get_state(),
+        "random_state": random.getstate(),
+        "done": done,
+    }
+
+def save_progress(dataset_dir, progress):
+    """Saves progress once its datapoints are on disk. Written to a temporary file and renamed
+    so that a run stopped mid-write leaves the previous progress intact.
+    """
+    temp_filename = progress_filename(dataset_dir) + ".tmp"
+    with open(temp_filename, "wb") as f:
+        pickle.dump(progress, f)
+    os.replace(temp_filename, progress_filename(dataset_dir))
+
+def save_written_progress(dataset, dataset_dir, checkpoints):
+    """Saves the latest of the checkpoints (progress after each object, oldest first) whose datapoints
+    have all been written by the dataset, and drops the saved and older checkpoints. Chunks are written in
+    the background, so this does not wait for them and progress trails the objects being rendered.
+    """
+    progress = None
+    while len(checkpoints) > 0 and checkpoints[0]["num_datapoints"] <= dataset.num_saved_datapoints:
+        progress = checkpoints.pop(0)
+    if progress is not None:
+        save_progress(dataset_dir, progress)
+
+def generate_dataset(config, dataset_dir, obj_ids=None, keep_progress=False):
+    """Renders the datapoints of the objects with the given ids (None for all objects) into the dataset at dataset_dir.
+    Object ids are global, so datasets written by parallel workers can be merged with TensorDataset.merge.
+    Progress is saved once the datapoints of an object are written, and a dataset left by an interrupted run
+    is appended to starting after the last saved object. With keep_progress, a completed dataset keeps its
+    progress file marked as done, and rerunning returns without rendering, e.g. for shards that are not merged yet.
+    """
+    # reseed so that forked workers do not render the same random poses
+    np.random.seed()
+    random.seed()
 
     # dataset configuration
+    last_obj_id, data_point_counter, objects_added = 0, 0, {}
     if not config['debug']:
         tensor_config = config['dataset']['tensors']
-        dataset = TensorDataset("/nfs/diskstation/projects/unsupervised_rbt/" + name_gen_dataset + "/", tensor_config)
+        progress = load_progress(dataset_dir)
+        if progress is not None and progress.get("done", False):
+            print(colored("Dataset " + dataset_dir + " is already complete", 'green'))
+            return
+        if progress is None:
+            if keep_progress and os.path.exists(dataset_dir):
+                # a shard that stopped before saving any progress has no completed objects
+                shutil.rmtree(dataset_dir)
+            dataset = TensorDataset(dataset_dir, tensor_config, async_write=True)
+            save_progress(dataset_dir, get_progress(last_obj_id, data_point_counter, objects_added))
+        else:
+            dataset = TensorDataset.open(dataset_dir, access_mode=READ_WRITE_ACCESS, async_write=True)
+            last_obj_id, data_point_counter = progress["obj_id"], progress["num_datapoints"]
+            objects_added = dict.fromkeys(progress["objects_added"], 1)
+            if dataset.num_datapoints < data_point_counter:
+                raise ValueError("Dataset %s has %d datapoints but %d were saved before it was interrupted"
+                                 % (dataset_dir, dataset.num_datapoints, data_point_counter))
+            # drop the datapoints of the object that was being rendered when the run stopped
+            if dataset.num_datapoints > data_point_counter:
+                dataset.truncate(data_point_counter)
+            np.random.set_state(progress["np_random_state"])
+            random.setstate(progress["random_state"])
+            print(colored("Resuming after object " + str(last_obj_id) + " with " + str(data_point_counter)
+                          + " datapoints", 'green'))
         datapoint = dataset.datapoint_template
     scene, renderer = create_scene_real(config)
     # print("NUM OBJECTS")
@@ -60,13 +138,13 @@ if __name__ == "__main__":
     num_samples_per_obj = config['num_samples_per_obj']
 
     obj_id = 0
-    data_point_counter = 0
     wrong_counter = 0
+    checkpoints = []
     # scales = pickle.load(open("cfg/tools/data/scales", "rb"))
     # print(max(scales.values()), min(scales.values()))
     # split = np.loadtxt('cfg/tools/data/train_split_546')
 
-    objects_added, points_1000, eccentricities, max_bb = {}, {}, {}, {}
+    points_1000, eccentricities, max_bb = {}, {}, {}
     scores = np.loadtxt("cfg/tools/data/final_scores")
     # split_872 = np.loadtxt("cfg/tools/data/train_split_872")
 
@@ -77,6 +155,10 @@ if __name__ == "__main__":
 
     for mesh_dir, mesh_filename in Load_Mesh_Path():
         obj_id += 1
+        if obj_ids is not None and obj_id not in obj_ids:
+            continue
+        if obj_id <= last_obj_id:
+            continue
         # if obj_id != 73: #2 donut, 4 elephant, 6 is bottle, 31 L-Shaped, 73 L-Shaped, 90 twisty mug, 156 polygonal insertion
         #     continue
         # dataset.flush()
@@ -167,6 +249,10 @@ if __name__ == "__main__":
                             "in", round(time.time() - start_time, 2), "seconds")
         # delete the object to make room for the next
         scene.remove_node(object_node)
+
+        # checkpoint so that an interrupted run can continue from the next object
+        checkpoints.append(get_progress(obj_id, data_point_counter, objects_added))
+        save_written_progress(dataset, dataset_dir, checkpoints)
     objects_added = np.array(list(objects_added.keys()),dtype=int)
     np.random.shuffle(objects_added)
     print("Added", data_point_counter, "datapoints to dataset from ", len(objects_added), "objects")
@@ -181,3 +267,44 @@ if __name__ == "__main__":
     # pickle.dump(eccentricities, open("cfg/tools/data/eccentricities", "wb"))
     # pickle.dump(max_bb, open("cfg/tools/data/max_bb", "wb"))
     dataset.flush()
+    if keep_progress:
+        # keep the dataset marked as complete until it is merged
+        save_progress(dataset_dir, get_progress(obj_id, data_point_counter, dict.fromkeys(objects_added.tolist(), 1), done=True))
+    else:
+        os.remove(progress_filename(dataset_dir))
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = YamlConfig(args.config)
+    # to adjust
+    name_gen_dataset = args.dataset
+    if config['debug']:
+        name_gen_dataset += "_junk"
+    dataset_dir = "/nfs/diskstation/projects/unsupervised_rbt/" + name_gen_dataset + "/"
+
+    if args.num_workers <= 1 or config['debug']:
+        generate_dataset(config, dataset_dir)
+    else:
+        # each worker renders a contiguous range of objects into a shard, and the shards are linked
+        # into a single dataset. The datapoints of the last partial file of each shard are moved to
+        # the end, so the merged dataset is not ordered by object id
+        if os.path.exists(dataset_dir):
+            raise ValueError("Dataset %s already exists!" % dataset_dir)
+        num_objects = len(list(Load_Mesh_Path()))
+        worker_obj_ids = np.array_split(np.arange(1, num_objects+1), args.num_workers)
+        shards_dir = dataset_dir.rstrip('/') + "_shards/"
+        if not os.path.exists(shards_dir):
+            os.mkdir(shards_dir)
+        shard_dirs = [os.path.join(shards_dir, "shard_%02d" % worker_num) for worker_num in range(args.num_workers)]
+        workers = [multiprocessing.Process(target=generate_dataset, args=(config, shard_dir, set(obj_ids.tolist()), True))
+                   for shard_dir, obj_ids in zip(shard_dirs, worker_obj_ids)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [worker_num for worker_num, worker in enumerate(workers) if worker.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError("Workers %s failed, shards are kept in %s" % (failed, shards_dir))
+        dataset = TensorDataset.merge(shard_dirs, dataset_dir, delete_shards=True)
+        os.rmdir(shards_dir)
+        print("Merged", dataset.num_datapoints, "datapoints from", args.num_workers, "shards")
@@ -371,13 +371,8 @@ if __name__ == '__main__':
 
     if not os.path.exists(args.dataset + "/splits/train"):
         obj_id_split = np.loadtxt("cfg/tools/data/train_split")
-        val_indices = []
-        for i in range(dataset.num_datapoints):
-            if dataset.datapoint(i)["obj_id"] in obj_id_split:
-                val_indices.append(i)
-
+        dataset.make_split("train", field_name="obj_id", val_values=obj_id_split)
         print("Created Train Split")
-        dataset.make_split("train", train_pct=0.8, val_indices= val_indices)
     if not os.path.exists(args.dataset + "/splits/train2"):
         dataset.make_split("train2", train_pct=0.8)
 
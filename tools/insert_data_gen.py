@@ -1,4 +1,4 @@
-from autolab_core import YamlConfig, RigidTransform, TensorDataset
+from autolab_core import YamlConfig, RigidTransform
 from scipy.spatial.transform import Rotation
 import os
 import time
@@ -23,6 +23,7 @@ import random
 from termcolor import colored
 import pickle
 from tools.utils import *
+from unsupervised_rbt import TensorDataset
 
 def create_scene(data_gen=True):
     """Create scene for taking depth images.
@@ -102,7 +103,7 @@ if __name__ == "__main__":
     else:
         # dataset configuration
         tensor_config = config['dataset']['tensors']
-        dataset = TensorDataset("/nfs/diskstation/projects/unsupervised_rbt/" + name_gen_dataset + "/", tensor_config)
+        dataset = TensorDataset("/nfs/diskstation/projects/unsupervised_rbt/" + name_gen_dataset + "/", tensor_config, async_write=True)
         datapoint = dataset.datapoint_template
     scene, renderer, table_mesh, table_node, scene2 = create_scene()
 
@@ -2,7 +2,7 @@
 This script generates data for the self-supervised rotation prediction task
 '''
 
-from autolab_core import YamlConfig, RigidTransform, TensorDataset
+from autolab_core import YamlConfig, RigidTransform
 from scipy.spatial.transform import Rotation
 import os
 import time
@@ -25,6 +25,7 @@ import random
 from termcolor import colored
 import pickle
 from tools.utils import *
+from unsupervised_rbt import TensorDataset
 
 def parse_args():
     """Parse arguments from the command line.
@@ -51,7 +52,7 @@ if __name__ == "__main__":
 
     # dataset configuration
     tensor_config = config['dataset']['tensors']
-    dataset = TensorDataset("/nfs/diskstation/projects/unsupervised_rbt/" + name_gen_dataset + "/", tensor_config)
+    dataset = TensorDataset("/nfs/diskstation/projects/unsupervised_rbt/" + name_gen_dataset + "/", tensor_config, async_write=True)
     datapoint = dataset.datapoint_template
     scene, renderer = create_scene()
     dataset_name_list = ['3dnet', 'thingiverse', 'kit']
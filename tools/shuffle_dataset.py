@@ -1,71 +1,95 @@
-from autolab_core import YamlConfig, RigidTransform
+'''
+Writes a copy of a tensor dataset with its datapoints in a uniformly random order, using bounded memory.
+The shuffle takes two passes: each datapoint is first sent to a random bucket on disk, reading the
+input one tensor file at a time, then each bucket is loaded, shuffled in memory and appended to the
+output dataset in bulk. Buckets are sized so that a bucket fits in -max_memory gigabytes.
+'''
+from autolab_core import YamlConfig
 from unsupervised_rbt import TensorDataset
 import os
 
 import numpy as np
-import sys
+import shutil
 import argparse
 
-import random
 from tqdm import tqdm
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    default_config_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                           '..',
-                                           'cfg/tools/data_gen_quat.yaml')
-    parser.add_argument('-config', type=str, default=default_config_filename)
+    parser.add_argument('-config', type=str, default=None,
+                        help='yaml config with the output tensor config under dataset/tensors (default: same as input)')
     parser.add_argument('-input_dataset', type=str, required=True)
     parser.add_argument('-output_dataset', type=str, required=True)
+    parser.add_argument('-max_memory', type=float, default=8.0, help='memory for a single bucket in GB')
+    parser.add_argument('-seed', type=int, default=None)
     args = parser.parse_args()
     return args
-    
+
+def bucket_filename(bucket_dir, bucket, field_name):
+    return os.path.join(bucket_dir, '%s_%05d.npy' % (field_name, bucket))
+
 if __name__ == "__main__":
     args = parse_args()
-    config = YamlConfig(args.config)
-    # to adjust
-    name_gen_dataset = args.input_dataset
     dataset_root_path = "/nfs/diskstation/projects/unsupervised_rbt/"
-    
-    # dataset configuration
-    tensor_config = config['dataset']['tensors']
-    dataset = TensorDataset(dataset_root_path + args.output_dataset, tensor_config)
-    
+    random_state = np.random.RandomState(args.seed)
+
     # load the old dataset
-    old_dataset = TensorDataset.open(dataset_root_path + name_gen_dataset)
-    
-    # iterate over it and mix stuff up
-    print("old dataset has datapoints: ", old_dataset.num_datapoints)
-    idx = np.arange(0,old_dataset.num_datapoints, 512*128)
-    print(idx)
-    # np.random.shuffle(idx)
-    
-    # import pdb
-    # pdb.set_trace()
-    for i in tqdm(idx):
-        batch = old_dataset.get_item_list(np.arange(i, np.min((old_dataset.num_datapoints,i+512*128))))
+    old_dataset = TensorDataset.open(dataset_root_path + args.input_dataset)
+    num_datapoints = old_dataset.num_datapoints
+    print("old dataset has datapoints: ", num_datapoints)
+
+    # dataset configuration
+    if args.config is not None:
+        tensor_config = YamlConfig(args.config)['dataset']['tensors']
+    else:
+        tensor_config = old_dataset.config
+    dataset = TensorDataset(dataset_root_path + args.output_dataset, tensor_config, async_write=True)
 
-        depth_image1 = np.expand_dims(np.squeeze(batch["depth_image1"]),-1)
-        depth_image2 = np.expand_dims(np.squeeze(batch["depth_image2"]),-1)
-        obj_id = batch["obj_id"]
-        lie = batch["lie"]
-        quaternion = batch["quaternion"]
-        pose_matrix = batch["pose_matrix"]
-        # print(depth_image1.shape)
+    # assign every datapoint to a random bucket, with enough buckets that each fits in memory
+    template = old_dataset.datapoints([0])
+    datapoint_size = sum(value.nbytes for value in template.values())
+    num_buckets = int(np.ceil(float(num_datapoints * datapoint_size) / (args.max_memory * 1e9 / 2)))
+    num_buckets = max(num_buckets, 1)
+    buckets = random_state.randint(num_buckets, size=num_datapoints)
+    bucket_sizes = np.bincount(buckets, minlength=num_buckets)
+    print("shuffling through", num_buckets, "buckets")
 
-        idx_batch = np.arange(0,len(depth_image1))
-        np.random.shuffle(idx_batch)
-        for j in tqdm(idx_batch):
-            datapoint = dataset.datapoint_template
-            datapoint["depth_image1"] = depth_image1[j]
-            datapoint["depth_image2"] = depth_image2[j]
-            datapoint["obj_id"] = obj_id[j]
-            datapoint["lie"] = lie[j]
-            datapoint["quaternion"] = quaternion[j]
-            datapoint["pose_matrix"] = pose_matrix[j]
-            dataset.add(datapoint)
-            # print("Adding object", obj_id[j])
-#         print("\n num datapoints in set: ", dataset.num_datapoints)
-        
-    dataset.flush()
+    bucket_dir = dataset_root_path + args.output_dataset.rstrip('/') + "_buckets"
+    os.mkdir(bucket_dir)
+    try:
+        # pass 1: scatter the datapoints of each tensor file into the buckets
+        bucket_tensors = {}
+        for bucket in range(num_buckets):
+            for field_name, value in template.items():
+                bucket_tensors[bucket, field_name] = np.lib.format.open_memmap(
+                    bucket_filename(bucket_dir, bucket, field_name), mode='w+',
+                    dtype=value.dtype, shape=(int(bucket_sizes[bucket]),) + value.shape[1:])
+        bucket_counts = np.zeros(num_buckets, dtype=np.int64)
+        for tensor_ind in tqdm(range(old_dataset.num_tensors)):
+            indices = old_dataset.datapoint_indices_for_tensor(tensor_ind)
+            batch = old_dataset.datapoints(indices)
+            batch_buckets = buckets[indices]
+            for bucket in np.unique(batch_buckets):
+                in_bucket = batch_buckets == bucket
+                start, end = bucket_counts[bucket], bucket_counts[bucket] + np.sum(in_bucket)
+                for field_name, value in batch.items():
+                    bucket_tensors[bucket, field_name][start:end] = value[in_bucket]
+                bucket_counts[bucket] = end
+            old_dataset.clear_cache()
+        for tensor in bucket_tensors.values():
+            tensor.flush()
+        del bucket_tensors
 
+        # pass 2: shuffle each bucket in memory and append it to the new dataset
+        for bucket in tqdm(range(num_buckets)):
+            permutation = random_state.permutation(bucket_sizes[bucket])
+            batch = {}
+            for field_name in template.keys():
+                filename = bucket_filename(bucket_dir, bucket, field_name)
+                batch[field_name] = np.load(filename)[permutation]
+                os.remove(filename)
+            dataset.add_batch(batch)
+        dataset.flush()
+    finally:
+        shutil.rmtree(bucket_dir)
+    print("new dataset has datapoints: ", dataset.num_datapoints)
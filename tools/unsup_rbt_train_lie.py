@@ -17,7 +17,7 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 from autolab_core import YamlConfig, RigidTransform
-from unsupervised_rbt import TensorDataset
+from unsupervised_rbt import TensorDataset, TensorDatasetPrefetcher
 from unsupervised_rbt.models import ResNetSiameseNetwork, InceptionSiameseNetwork
 from unsupervised_rbt.losses.shapematch import ShapeMatchLoss, ShapeMatchLoss_Lie
 from perception import DepthImage, RgbdImage
@@ -89,14 +89,6 @@ def Plot_Predicted_Rotation(datapoint, predicted_quat):
             scene.set_pose(object_node, pose=new_pose)
             return renderer.render(scene, flags=RenderFlags.DEPTH_ONLY)
 
-def get_points(obj_ids, points_poses):
-    points = [point_clouds[obj_id] / scales[obj_id] * 10 for obj_id in obj_ids]
-    # print(batch["pose_matrix"][0])
-    points = [points_poses[i] @ points[i] for i in range(len(obj_ids))]
-    points = torch.Tensor(points).to(device)
-    # print(points[:,:5])
-    return points
-
 def train(dataset, batch_size, first=False):
     '''Train model specified in main and return training loss and classification accuracy'''
     model.train()
@@ -112,8 +104,8 @@ def train(dataset, batch_size, first=False):
     ones = torch.Tensor(np.ones(batch_size)).to(device)
     optimizer.zero_grad()
 
-    for step in tqdm(range(n_train_steps)):
-        batch = dataset.get_item_list(train_indices[step*batch_size: (step+1)*batch_size])
+    prefetcher = TensorDatasetPrefetcher(dataset, train_indices, batch_size, drop_last=True)
+    for batch in tqdm(prefetcher):
         # depth_image1 = Quantize(batch["depth_image1"])
         # depth_image2 = Quantize(batch["depth_image2"])
         depth_image1 = batch["depth_image1"]
@@ -135,7 +127,7 @@ def train(dataset, batch_size, first=False):
         #         plt.show()
         obj_ids = batch["obj_id"]
         points_poses = batch["pose_matrix"][:,:3,:3]
-        points = get_points(obj_ids, points_poses)
+        points = point_bank(obj_ids, points_poses)
 
         pred_transform = model(im1_batch, im2_batch)
         # if config['loss'] == 'cosine' or first:
@@ -174,8 +166,8 @@ def test(dataset, batch_size):
     ones = torch.Tensor(np.ones(batch_size)).to(device)
 
     with torch.no_grad():
-        for step in tqdm(range(n_test_steps)):
-            batch = dataset.get_item_list(test_indices[step*batch_size: (step+1)*batch_size])
+        prefetcher = TensorDatasetPrefetcher(dataset, test_indices, batch_size, drop_last=True)
+        for batch in tqdm(prefetcher):
             depth_image1 = batch["depth_image1"]
             depth_image2 = batch["depth_image2"]
 
@@ -187,7 +179,7 @@ def test(dataset, batch_size):
 
             obj_ids = batch["obj_id"]
             points_poses = batch["pose_matrix"][:,:3,:3]
-            points = get_points(obj_ids, points_poses)
+            points = point_bank(obj_ids, points_poses)
             # if config['loss'] == 'cosine':
                 # loss = loss_func(pred_transform, transform_batch, ones)
             loss = loss_func(pred_transform, transform_batch)
@@ -203,6 +195,7 @@ def parse_args():
     -config to input your own yaml config file. Default is unsup_rbt_train_quat.yaml
     -dataset to input a name for your dataset. Should start with quaternion
     --test to generate a graph of your train and validation loss
+    -local_cache_dir to copy the tensor files of the dataset to a local disk as they are first read
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('--test', action='store_true')
@@ -212,6 +205,7 @@ def parse_args():
                                            'cfg/tools/unsup_rbt_train_quat.yaml')
     parser.add_argument('-config', type=str, default=default_config_filename)
     parser.add_argument('-dataset', type=str, required=True)
+    parser.add_argument('-local_cache_dir', type=str, default=None)
     args = parser.parse_args()
     return args
 
@@ -238,7 +232,7 @@ if __name__ == '__main__':
     config = YamlConfig(args.config)
     dataset_name = args.dataset + "/"
     args.dataset = os.path.join('/nfs/diskstation/projects/unsupervised_rbt', args.dataset)
-    dataset = TensorDataset.open(args.dataset)
+    dataset = TensorDataset.open(args.dataset, local_cache_dir=args.local_cache_dir)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     
     prefix = "lie"
@@ -256,6 +250,7 @@ if __name__ == '__main__':
     # point_clouds = pickle.load(open("cfg/tools/data/point_clouds", "rb"))
     point_clouds = pickle.load(open("cfg/tools/data/point_clouds300", "rb"))
     scales = pickle.load(open("cfg/tools/data/scales", "rb"))
+    point_bank = PointCloudBank(point_clouds, scales, device)
 
     # optimizer = optim.Adam(model.parameters())
     optimizer = optim.Adam(model.parameters(), lr=1e-4, weight_decay=10**(-1 * config['reg']))
@@ -267,13 +262,8 @@ if __name__ == '__main__':
     if not args.test:
         if not os.path.exists(args.dataset + "/splits/train"):
             obj_id_split = np.loadtxt("cfg/tools/data/train_split")
-            val_indices = []
-            for i in range(dataset.num_datapoints):
-                if dataset.datapoint(i)["obj_id"] in obj_id_split:
-                    val_indices.append(i)
-
+            dataset.make_split("train", field_name="obj_id", val_values=obj_id_split)
             print("Created Train Split")
-            dataset.make_split("train", train_pct=0.8, val_indices= val_indices)
         if not os.path.exists(args.dataset + "/splits/train2"):
             dataset.make_split("train2", train_pct=0.8)
 
@@ -336,7 +326,7 @@ if __name__ == '__main__':
                 
                 obj_ids = batch["obj_id"]
                 points_poses = batch["pose_matrix"][:,:3,:3]
-                points = get_points(obj_ids, points_poses)
+                points = point_bank(obj_ids, points_poses)
                 sm_loss = loss_func2(pred_transform, transform_batch, points).item()
 
                 # true_quaternions.extend(transform_batch.cpu().numpy())
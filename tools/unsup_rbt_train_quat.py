@@ -11,11 +11,13 @@ import torchvision
 import torch.optim as optim
 from torch.autograd import Variable
 import pickle
+import contextlib
+import resource
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 from autolab_core import YamlConfig, RigidTransform
-from unsupervised_rbt import TensorDataset
+from unsupervised_rbt import TensorDataset, TensorDatasetPrefetcher
 from unsupervised_rbt.models import ResNetSiameseNetwork, Se3TrackNet
 from unsupervised_rbt.losses.shapematch import ShapeMatchLoss
 # from perception import DepthImage, RgbdImage
@@ -23,6 +25,10 @@ from tools.utils import *
 
 import time 
 
+# automatic mixed precision needs torch >= 1.6, channels last memory format torch >= 1.5
+AMP_AVAILABLE = hasattr(torch.cuda, 'amp') and hasattr(torch.cuda.amp, 'GradScaler')
+CHANNELS_LAST_AVAILABLE = hasattr(torch, 'channels_last')
+
 def Make_Train_Splits(dataset_path, dataset):
     """Split the data into training and validation..
     Split 'train' adds all objects from a file to the validation split and leaves the rest in training
@@ -31,14 +37,41 @@ def Make_Train_Splits(dataset_path, dataset):
         print("Creating Train Split")
         obj_id_split = np.loadtxt("cfg/tools/data/train_split_872")
         # obj_id_split = np.loadtxt("cfg/tools/data/train_split_100")
-        val_indices = []
-        for i in tqdm(range(dataset.num_datapoints)):
-            if dataset.datapoint(i)["obj_id"] in obj_id_split:
-                val_indices.append(i)
-        dataset.make_split("train", train_pct=0.8, val_indices=val_indices)
+        dataset.make_split("train", field_name="obj_id", val_values=obj_id_split)
     if not os.path.exists(dataset_path + "/splits/train2"):
         dataset.make_split("train2", train_pct=0.8)
 
+class NoGradScaler(object):
+    """Stands in for torch.cuda.amp.GradScaler when it is not available, without scaling."""
+    def scale(self, loss):
+        return loss
+
+    def step(self, optimizer):
+        optimizer.step()
+
+    def update(self):
+        pass
+
+def image_batch(depth_image):
+    """Moves a batch of depth images to the device, in the memory format of the model."""
+    im_batch = torch.from_numpy(depth_image).float().to(device)
+    if use_channels_last:
+        im_batch = im_batch.contiguous(memory_format=torch.channels_last)
+    return im_batch
+
+def reset_peak_memory():
+    if device.type == 'cuda':
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        else:
+            torch.cuda.reset_max_memory_allocated(device)
+
+def peak_memory_mb():
+    """Peak GPU memory allocated since the last reset, or the peak resident memory of the process on CPU."""
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
 def train(dataset, batch_size, first=False):
     '''Train model specified in main and return training loss and classification accuracy'''
     model.train()
@@ -53,22 +86,29 @@ def train(dataset, batch_size, first=False):
 
     ones = torch.Tensor(np.ones(batch_size)).to(device)
     optimizer.zero_grad()
+    accumulation_steps = config['accumulation_steps']
+    autocast = torch.cuda.amp.autocast if use_amp else contextlib.ExitStack
+    reset_peak_memory()
+    start_time = time.time()
 
-    for step in tqdm(range(n_train_steps)):
-        batch = dataset.get_item_list(train_indices[step*batch_size: (step+1)*batch_size])
+    prefetcher = TensorDatasetPrefetcher(dataset, train_indices, batch_size, drop_last=True)
+    for step, batch in enumerate(tqdm(prefetcher)):
         depth_image1 = Quantize(batch["depth_image1"],demean=config['demean'])
         depth_image2 = Quantize(batch["depth_image2"],demean=config['demean'])
         # depth_image1 = batch["depth_image1"]
         # depth_image2 = batch["depth_image2"]
 
-        im1_batch = Variable(torch.from_numpy(depth_image1).float()).to(device)
-        im2_batch = Variable(torch.from_numpy(depth_image2).float()).to(device)
+        im1_batch = image_batch(depth_image1)
+        im2_batch = image_batch(depth_image2)
         true_quaternions = Variable(torch.from_numpy(batch["quaternion"])).to(device)
         obj_ids = batch["obj_id"]
         points_poses = batch["pose_matrix"][:,:3,:3]
-        points = point_cloud_fn(obj_ids, points_poses, point_clouds, scales, device)
+        points = point_bank(obj_ids, points_poses)
 
-        pred_quaternions = model(im1_batch, im2_batch)
+        with autocast():
+            pred_quaternions = model(im1_batch, im2_batch)
+        # the losses are computed in fp32 so that the shape-match loss is the same as without amp
+        pred_quaternions = pred_quaternions.float()
         if config['loss'] == 'cosine' or first:
             loss = loss_func(pred_quaternions, true_quaternions, ones)
             sm_loss = loss_func2(pred_quaternions, true_quaternions, points).item()
@@ -76,15 +116,12 @@ def train(dataset, batch_size, first=False):
             loss = loss_func2(pred_quaternions, true_quaternions, points)
             sm_loss = loss.item()
 
-        # loss = loss / 3
-        # loss.backward()
-        # if step % 3 == 2 or step == n_train_steps - 1:
-        #     optimizer.step()
-        #     optimizer.zero_grad()
-
-        loss.backward()
-        optimizer.step()
-        optimizer.zero_grad()
+        # the loss is scaled to avoid fp16 gradient underflow with amp, and averaged over the accumulated batches
+        scaler.scale(loss / accumulation_steps).backward()
+        if step % accumulation_steps == accumulation_steps - 1 or step == n_train_steps - 1:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
 
         train_loss += sm_loss
 
@@ -93,6 +130,8 @@ def train(dataset, batch_size, first=False):
         #     print(transform_batch[:3])
             # print(loss_func(pred_transform, transform_batch, points))
 
+    print("Train: %.1f samples/sec, peak memory %.0f MB" %
+          (n_train_steps * batch_size / (time.time() - start_time), peak_memory_mb()))
     return train_loss/n_train_steps
 
 def test(dataset, batch_size):
@@ -111,22 +150,22 @@ def test(dataset, batch_size):
     ones = torch.Tensor(np.ones(batch_size)).to(device)
 
     with torch.no_grad():
-        for step in tqdm(range(n_test_steps)):
-            batch = dataset.get_item_list(test_indices[step*batch_size: (step+1)*batch_size])
+        prefetcher = TensorDatasetPrefetcher(dataset, test_indices, batch_size, drop_last=True)
+        for batch in tqdm(prefetcher):
             depth_image1 = Quantize(batch["depth_image1"],demean=config['demean'])
             depth_image2 = Quantize(batch["depth_image2"],demean=config['demean'])
             # depth_image1 = batch["depth_image1"]
             # depth_image2 = batch["depth_image2"]
 
-            im1_batch = Variable(torch.from_numpy(depth_image1).float()).to(device)
-            im2_batch = Variable(torch.from_numpy(depth_image2).float()).to(device)
+            im1_batch = image_batch(depth_image1)
+            im2_batch = image_batch(depth_image2)
             true_quaternions = Variable(torch.from_numpy(batch["quaternion"])).to(device)
             pred_quaternions = model(im1_batch, im2_batch)
             total += true_quaternions.size(0)
 
             obj_ids = batch["obj_id"]
             points_poses = batch["pose_matrix"][:,:3,:3]
-            points = point_cloud_fn(obj_ids, points_poses, point_clouds, scales, device)
+            points = point_bank(obj_ids, points_poses)
             # if config['loss'] == 'cosine':
             #     loss = loss_func(pred_quaternions, true_quaternions, ones)
 
@@ -140,6 +179,7 @@ def parse_args():
     -config to input your own yaml config file. Default is unsup_rbt_train_quat.yaml
     -dataset to input a name for your dataset. Should start with quaternion
     --test to generate a graph of your train and validation loss
+    -local_cache_dir to copy the tensor files of the dataset to a local disk as they are first read
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('--test', action='store_true')
@@ -149,6 +189,7 @@ def parse_args():
                                            'cfg/tools/unsup_rbt_train_quat.yaml')
     parser.add_argument('-config', type=str, default=default_config_filename)
     parser.add_argument('-dataset', type=str, required=True)
+    parser.add_argument('-local_cache_dir', type=str, default=None)
     args = parser.parse_args()
     return args
 
@@ -165,7 +206,7 @@ if __name__ == '__main__':
     config = YamlConfig(args.config)
     dataset_name = args.dataset + "/"
     args.dataset = os.path.join('/nfs/diskstation/projects/unsupervised_rbt', args.dataset)
-    dataset = TensorDataset.open(args.dataset)
+    dataset = TensorDataset.open(args.dataset, local_cache_dir=args.local_cache_dir)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     
     prefix = "cos" if config['loss'] == "cosine" else "cos_sm"
@@ -182,18 +223,26 @@ if __name__ == '__main__':
 
     model = ResNetSiameseNetwork(split_resnet=config['split_resnet']).to(device)
     # model = Se3TrackNet().to(device)
+    use_channels_last = bool(config['channels_last'])
+    if use_channels_last and not CHANNELS_LAST_AVAILABLE:
+        print("Channels last memory format needs torch >= 1.5, using the default memory format")
+        use_channels_last = False
+    if use_channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    use_amp = bool(config['amp'])
+    if use_amp and (not AMP_AVAILABLE or device.type != 'cuda'):
+        print("Mixed precision needs torch >= 1.6 and a GPU, training in fp32")
+        use_amp = False
+    if AMP_AVAILABLE:
+        scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+    else:
+        scaler = NoGradScaler()
 
     point_clouds = pickle.load(open("cfg/tools/data/surface_pc_1000", "rb"))
     # point_clouds = pickle.load(open("cfg/tools/data/point_clouds", "rb"))
-    point_cloud_fn = get_points_random_obj if config['shuffled'] else get_points_single_obj
     scales = pickle.load(open("cfg/tools/data/scales", "rb"))
-    
-    if config['shuffled']:
-        point_clouds_arr = np.zeros((len(point_clouds),3,1000))
-        for obj_id in range(1,len(point_clouds_arr)+1):
-            point_clouds_arr[obj_id-1] = point_clouds[obj_id] / scales[obj_id] * 10
-        point_cloud_fn = get_points_numpy
-        point_clouds = point_clouds_arr
+    # normalized point clouds of all objects on the device, works for shuffled and single object batches
+    point_bank = PointCloudBank(point_clouds, scales, device)
     # optimizer = optim.Adam(model.parameters())
     optimizer = optim.Adam(model.parameters(), lr=2e-3, weight_decay=10**(-1 * config['reg']))
     scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=5,gamma=0.95)
@@ -268,7 +317,7 @@ if __name__ == '__main__':
 
                 obj_ids = batch["obj_id"]
                 points_poses = batch["pose_matrix"][:,:3,:3]
-                points = point_cloud_fn(obj_ids, points_poses, point_clouds, scales, device)
+                points = point_bank(obj_ids, points_poses)
                 sm_loss = loss_func2(pred_transform, transform_batch, points).item()
 
                 true_quaternions_list.extend(transform_batch.cpu().numpy())
@@ -2,7 +2,8 @@ from __future__ import division
 from perception import DepthImage
 from autolab_core import PointCloud, RigidTransform
 import numpy as np
-from tools.utils.stable_pose_utils import pointcloud
+from tools.utils.stable_pose_utils import pointcloud, to_numpy, rotated_nearest_distances
+from scipy.spatial import cKDTree
 import trimesh
 import torch
 from sklearn.decomposition import PCA
@@ -61,8 +62,12 @@ def decenter(pc):
     return pc - bb_center
 
 class PoseEstimator(object):
-    def __init__(self):
-
+    def __init__(self, backend='kdtree'):
+        """backend: 'kdtree' to find the best rotation with KD-trees on CPU,
+        'chamfer' for the brute force chamfer distance between all pairs of points on the GPU
+        """
+        self.backend = backend
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.k, self.thresh, self.batch = 360, 0.00002, 360
         thetas = np.array([2 * np.pi * j / self.batch for j in range(self.batch)])
         offset = thetas[1] / (self.k // self.batch)
@@ -70,45 +75,49 @@ class PoseEstimator(object):
         R0 = np.array([[[np.cos(theta), -np.sin(theta), 0],
                 [np.sin(theta), np.cos(theta), 0],
                 [0          ,0              , 1]]  for theta in thetas])
-        R0 = torch.Tensor(R0).to('cuda')
+        R0 = torch.Tensor(R0).to(self.device)
 
         R1 = np.array([[[np.cos(theta), -np.sin(theta), 0],
                 [np.sin(theta), np.cos(theta), 0],
                 [0          ,0              , 1]]  for theta in thetas + (offset * 1)])
-        R1 = torch.Tensor(R1).to('cuda')
+        R1 = torch.Tensor(R1).to(self.device)
 
         R2 = np.array([[[np.cos(theta), -np.sin(theta), 0],
                 [np.sin(theta), np.cos(theta), 0],
                 [0          ,0              , 1]]  for theta in thetas + (offset * 2)])
-        R2 = torch.Tensor(R2).to('cuda')
+        R2 = torch.Tensor(R2).to(self.device)
 
         R3 = np.array([[[np.cos(theta), -np.sin(theta), 0],
                 [np.sin(theta), np.cos(theta), 0],
                 [0          ,0              , 1]]  for theta in thetas + (offset * 3)])
-        R3 = torch.Tensor(R3).to('cuda')
+        R3 = torch.Tensor(R3).to(self.device)
 
         R4 = np.array([[[np.cos(theta), -np.sin(theta), 0],
                 [np.sin(theta), np.cos(theta), 0],
                 [0          ,0              , 1]]  for theta in thetas + (offset * 4)])
-        R4 = torch.Tensor(R4).to('cuda')
+        R4 = torch.Tensor(R4).to(self.device)
 
         self.R = [R0,R1,R2,R3,R4]
+        self.R_numpy = np.concatenate([R.cpu().numpy() for R in self.R[:self.k//self.batch]])
+        self.angles = np.concatenate([thetas + (offset * i) for i in range(self.k//self.batch)])
 
     def get_rotation(self, im1_batch, im2_batch): # input batch x 1 x height x width
         depth1, depth2 = im1_batch[0][0].cpu().numpy(), im2_batch[0][0].cpu().numpy()
         pc1, pc2 = pointcloud(depth1,300), pointcloud(depth2,300) #3xn1, 3xn2
         random_idx = np.random.randint(0,pc1.shape[1],size=500), np.random.randint(0,pc2.shape[1],size=500)
         pc1, pc2 = pc1[:,random_idx[0]], pc2[:,random_idx[1]]
-        pc1 = torch.Tensor(demean(pc1)).float().to("cuda")
-        pc2 = torch.Tensor(demean(pc2)).float().to("cuda")
+        pc1 = torch.Tensor(demean(pc1)).float().to(self.device)
+        pc2 = torch.Tensor(demean(pc2)).float().to(self.device)
         rot = self._is_match(pc1,pc2)
         pred_quat = RigidTransform.quaternion_from_axis_angle(np.array([0,0,1])*rot)
         quat = np.array([pred_quat[1],pred_quat[2],pred_quat[3],pred_quat[0]])
-        tensor_quat = torch.from_numpy(quat).float().to('cuda').unsqueeze(0)
+        tensor_quat = torch.from_numpy(quat).float().to(self.device).unsqueeze(0)
         return tensor_quat
 
     def _is_match(self, pc1, pc2):
         #pc1 and pc2 are 3xn_1, 3xn_2 point clouds
+        if self.backend == 'kdtree':
+            return self._is_match_kdtree(pc1, pc2)
         # median_pc_distance(pc1)
         # print(pc1.mean(1), pc2.mean(1))
         min_dist = 999999
@@ -126,6 +135,19 @@ class PoseEstimator(object):
         # print("Rotation around z is:", rot * 180 / np.pi)
         return rot + 1e-8
 
+    def _is_match_kdtree(self, pc1, pc2):
+        """Same as _is_match, with the nearest points found in KD-trees of pc1 and pc2 that are
+        built once. The distances from pc2 to the rotated pc1 are those from the inversely
+        rotated pc2 to pc1, so neither tree has to be rebuilt for each rotation.
+        """
+        pc1, pc2 = to_numpy(pc1).astype(np.float64), to_numpy(pc2).astype(np.float64)
+        tree1, tree2 = cKDTree(pc1.T), cKDTree(pc2.T)
+        dist1 = np.concatenate([dists.sum(1) for dists in rotated_nearest_distances(tree2, pc1, self.R_numpy, self.batch)])
+        dist2 = np.concatenate([dists.sum(1) for dists in rotated_nearest_distances(tree1, pc2, self.R_numpy.transpose(0,2,1), self.batch)])
+        rot = self.angles[np.argmin(dist1 + dist2)]
+        # print("Rotation around z is:", rot * 180 / np.pi)
+        return rot + 1e-8
+
     def depth_to_world_seg(self, depth):
         point_cloud_cam = self._camera_intr.deproject(depth)
         point_cloud_cam.remove_zero_points()
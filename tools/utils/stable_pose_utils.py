@@ -1,5 +1,6 @@
 from autolab_core import YamlConfig, RigidTransform, TensorDataset
 from scipy.spatial.transform import Rotation
+from scipy.spatial import cKDTree
 import os
 import time
 import torch
@@ -18,14 +19,42 @@ from tools.chamfer_distance import ChamferDistance
 from sklearn.metrics import precision_recall_curve, roc_curve, confusion_matrix, ConfusionMatrixDisplay
 
 k, thresh, trans, batch = 7200*3, 0.00001, 0.01, 7200*3
+query_batch = 360 # rotations per KD-tree query
 thetas = [2 * np.pi * j / batch for j in range(batch)]
-R = np.array([[[np.cos(theta), -np.sin(theta), 0],
+R_numpy = np.array([[[np.cos(theta), -np.sin(theta), 0],
         [np.sin(theta), np.cos(theta), 0],
         [0          ,0              , 1]]  for theta in thetas])
-R = torch.Tensor(R).to('cuda')
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+R = torch.Tensor(R_numpy).to(device)
+
+def to_numpy(pc):
+    return pc.cpu().numpy() if torch.is_tensor(pc) else np.asarray(pc)
+
+def tree_query(tree, points, **kwargs):
+    """Nearest neighbor distances of points (nx3) in the KD-tree, using all cores."""
+    try:
+        return tree.query(points, workers=-1, **kwargs)[0]
+    except TypeError: # scipy < 1.6
+        return tree.query(points, n_jobs=-1, **kwargs)[0]
+
+def rotated_nearest_distances(tree, pc, rotations, batch_size=query_batch, upper_bound=np.inf):
+    """Yields the squared distances from each point of each rotated copy of pc to its
+    closest point in the KD-tree, as batch_size x n arrays for consecutive batches of rotations.
+    tree: cKDTree of the target point cloud, built once
+    pc: 3xn point cloud
+    rotations: kx3x3 rotation matrices
+    upper_bound: distances above it are returned as inf, which prunes the search
+    """
+    n = pc.shape[1]
+    for start in range(0, len(rotations), batch_size):
+        points = np.matmul(rotations[start:start+batch_size], pc).transpose(0,2,1).reshape(-1,3)
+        dists = tree_query(tree, points, distance_upper_bound=upper_bound)
+        yield dists.reshape(-1, n) ** 2
 
-def is_match(pc1, pc2):
+def is_match(pc1, pc2, backend='kdtree'):
     #pc1 and pc2 are 3xn point clouds
+    if backend == 'kdtree':
+        return is_match_kdtree(pc1, pc2)
     # median_pc_distance(pc1)
     # print(pc1.mean(1), pc2.mean(1))
     d = (pc1.shape[1] * 4.75) // 5
@@ -37,7 +66,7 @@ def is_match(pc1, pc2):
         # T = np.array([[(np.random.random()*trans*2) - trans, (np.random.random()*trans*2) - trans,0] for theta in thetas])
         # T = torch.Tensor(T[:,:,None]).to('cuda')
         pc1_R = torch.bmm(R,pc1_batch) #+ T
-        chamfer_dist = ChamferDistance().to('cuda') # takes in two point clouds of nx3
+        chamfer_dist = ChamferDistance().to(device) # takes in two point clouds of nx3
         dist1, dist2 = chamfer_dist(pc1_R.transpose(2,1), pc2_batch.transpose(2,1)) #dist1 should be batch x n
         batch_inliers = torch.sum(dist1 < thresh, 1)
         num_inliers, best_inliers = torch.max(batch_inliers).item(), torch.argmax(batch_inliers).item()
@@ -57,6 +86,26 @@ def is_match(pc1, pc2):
     # print("Highest percent of inliers:", round(highest * 100,2))
     return (True, round(highest * 100,2)) if num_inliers > d else (False, round(highest * 100,2))
 
+def is_match_kdtree(pc1, pc2):
+    """Same as is_match, but counts the inliers of every rotation of pc1 with a KD-tree of pc2
+    instead of the brute force chamfer distance, so it runs on CPU in O(n log n) per rotation.
+    Like is_match, it stops after the first batch of rotations with more than d inliers and
+    returns the highest percent of inliers seen so far, so both backends give the same result.
+    """
+    pc1, pc2 = to_numpy(pc1).astype(np.float64), to_numpy(pc2).astype(np.float64)
+    d = (pc1.shape[1] * 4.75) // 5
+    tree = cKDTree(pc2.T)
+    highest = 0
+    for i in range(k//batch):
+        num_inliers = 0
+        for dists in rotated_nearest_distances(tree, pc1, R_numpy, upper_bound=np.sqrt(thresh)):
+            num_inliers = max(num_inliers, int(np.max(np.sum(dists < thresh, 1))))
+        if num_inliers / pc1.shape[1] > highest:
+            highest = num_inliers / pc1.shape[1]
+        if num_inliers > d:
+            break
+    return (True, round(highest * 100,2)) if num_inliers > d else (False, round(highest * 100,2))
+
 def plot_precision_recall_roc():
     results = np.load("results/pose_est/results.npy")
     analyze_results(results, save=False)
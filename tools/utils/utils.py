@@ -315,32 +315,6 @@ def Zero_BG(image, DR = True):
         image_new[mask2[0], mask2[1]] = 0
     return image_new
 
-def get_points_random_obj(obj_ids, points_poses, point_clouds, scales, device):
-    points = [point_clouds[obj_id] / scales[obj_id] * 10 for obj_id in obj_ids]
-    # print(batch["pose_matrix"][0])
-    points, points_poses = torch.Tensor(points).to(device), torch.Tensor(points_poses).to(device)
-    points = torch.bmm(points_poses, points)
-    # print(points[:,:5])
-    return points
-
-def get_points_numpy(obj_ids, points_poses, point_clouds, scales, device):
-    points = point_clouds[obj_ids-1]
-    # print(batch["pose_matrix"][0])
-    points, points_poses = torch.Tensor(points).to(device), torch.Tensor(points_poses).to(device)
-    points = torch.bmm(points_poses, points)
-    # print(points[:,:5])
-    return points
-
-def get_points_single_obj(obj_ids, points_poses, point_clouds, scales, device):
-    assert np.sum(obj_ids) == obj_ids[0] * len(obj_ids), "Obj_ID: {}".format(obj_ids)
-    pc1 = point_clouds[obj_ids[0]] / scales[obj_ids[0]] * 10
-    points = np.tile(pc1, (points_poses.shape[0],1,1))
-    # print(batch["pose_matrix"][0])
-    points, points_poses = torch.Tensor(points).to(device), torch.Tensor(points_poses).to(device)
-    points = torch.bmm(points_poses, points)
-    # print(points[:,:5])
-    return points
-
 def Quantize(img, demean=False):
     if demean:
         img_max = img.max()
@@ -374,3 +348,35 @@ def get_points_vertices(obj_ids, points_poses, point_clouds, scales, device):
     points, points_poses = torch.Tensor(points).to(device), torch.Tensor(points_poses).to(device)
     points = torch.bmm(points_poses, points)
     return points
+
+class PointCloudBank(object):
+    """Point clouds of all objects, normalized by their scales like the get_points functions
+    and stacked into one (max_obj_id + 1, 3, num_points) tensor on the device, so that
+    the points of a batch are a single gather and bmm instead of being rebuilt on the host.
+    """
+    def __init__(self, point_clouds, scales, device):
+        """
+        point_clouds: dict from obj_id to (3, num_points), with the same num_points for all objects
+        scales: dict from obj_id to scale
+        """
+        num_points = set(pc.shape[1] for pc in point_clouds.values())
+        if len(num_points) != 1:
+            raise ValueError("Point clouds must all have the same number of points, got {}".format(sorted(num_points)))
+        bank = np.zeros((max(point_clouds.keys()) + 1, 3, num_points.pop()))
+        for obj_id, pc in point_clouds.items():
+            bank[obj_id] = pc / scales[obj_id] * 10
+        self.device = device
+        self.points = torch.Tensor(bank).to(device)
+
+    def __call__(self, obj_ids, points_poses):
+        """obj_ids: (batch,)
+        points_poses: (batch, 3, 3)
+        Returns the rotated points of each object, (batch, 3, num_points)
+        """
+        if not torch.is_tensor(obj_ids):
+            obj_ids = torch.from_numpy(np.asarray(obj_ids, dtype=np.int64))
+        if not torch.is_tensor(points_poses):
+            points_poses = torch.from_numpy(np.asarray(points_poses, dtype=np.float32))
+        obj_ids = obj_ids.long().to(self.device, non_blocking=True)
+        points_poses = points_poses.float().to(self.device, non_blocking=True)
+        return torch.bmm(points_poses, self.points.index_select(0, obj_ids))
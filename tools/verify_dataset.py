@@ -0,0 +1,38 @@
+'''
+Checks the tensor files of a dataset against the sizes and checksums recorded in its index,
+e.g. to catch truncated files from an interrupted generation run before training.
+Datasets written before indexing was added can be indexed with -reindex.
+'''
+from unsupervised_rbt import TensorDataset
+from autolab_core.constants import READ_WRITE_ACCESS
+import os
+import sys
+import argparse
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dataset', type=str, required=True)
+    parser.add_argument('-num_workers', type=int, default=8)
+    parser.add_argument('-deep', action='store_true', help='also load every tensor and check its statistics')
+    parser.add_argument('-reindex', action='store_true', help='rebuild the index from the files on disk')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    dataset_root_path = "/nfs/diskstation/projects/unsupervised_rbt/"
+    dataset_path = os.path.join(dataset_root_path, args.dataset)
+    if args.reindex:
+        dataset = TensorDataset.open(dataset_path, access_mode=READ_WRITE_ACCESS)
+        dataset.reindex()
+        print("Indexed", dataset.num_tensors, "tensor files")
+    else:
+        dataset = TensorDataset.open(dataset_path)
+
+    problems = dataset.verify(num_workers=args.num_workers, deep=args.deep)
+    for problem in problems:
+        print(problem)
+    if len(problems) > 0:
+        print("Found", len(problems), "problems in", dataset.num_datapoints, "datapoints")
+        sys.exit(1)
+    print("Verified", dataset.num_datapoints, "datapoints in", dataset.num_tensors, "tensor files")
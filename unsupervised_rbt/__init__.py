@@ -1 +1,5 @@
 from .tensor_dataset import TensorDataset
+from .dataset_view import TensorDatasetView
+from .hdf5_dataset import HDF5TensorDataset, export_hdf5, import_hdf5
+from .prefetcher import TensorDatasetPrefetcher
+from .torch_dataset import TorchTensorDataset, ChunkBatchSampler
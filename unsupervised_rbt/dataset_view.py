@@ -0,0 +1,244 @@
+"""
+Read-only views of a TensorDataset defined by datapoint indices, a subset of the fields and
+per-field transforms, e.g. for evaluating on every other validation datapoint:
+
+    val_view = dataset.view(dataset.split('train')[1])[::2]
+    batch = val_view.get_item_list(np.arange(64))
+"""
+import numpy as np
+
+from .tensor_dataset import TensorDataset, TensorDatapoint, DEFAULT_CACHE_SIZE, ITEM_LIST_FIELD_NAMES
+
+class TensorDatasetView(object):
+    """ A subset of the datapoints and fields of a TensorDataset, addressed by local indices
+    0 ... len(view)-1. Views only store the global indices of their datapoints and read
+    through the batched path of the underlying dataset, so creating one copies no data.
+
+    Indexing a view with a slice or an array of local indices returns another view, and
+    transforms are applied in order to each batch of a field when it is read. Views can be
+    pickled to worker processes, which reopen the dataset read-only on first access, as long
+    as the transforms are picklable (e.g. module-level functions).
+    """
+    def __init__(self, dataset, indices=None, field_names=None, transforms=None,
+                 cache_size=DEFAULT_CACHE_SIZE, local_cache_dir=None):
+        """
+        Parameters
+        ----------
+        dataset : :obj:`TensorDataset` or str
+            the dataset, or the path to a dataset that is opened on first access
+        indices : :obj:`list` of int
+            global indices of the datapoints in the view, in order (None for all datapoints)
+        field_names : :obj:`list` of str
+            fields in the view (None for all fields)
+        transforms : dict
+            mapping from field name to a function applied to each batch of the field when it is read
+        cache_size : int
+            cache size in bytes per field when the dataset is opened by the view
+        local_cache_dir : str
+            local directory to stage the tensor files to when the dataset is opened by the view
+        """
+        self._dataset = None
+        if isinstance(dataset, TensorDataset):
+            self._dataset = dataset
+            self._dataset_dir = dataset.filename
+            self._cache_size = dataset.cache_size
+            self._local_cache_dir = dataset.local_cache_dir
+        else:
+            self._dataset_dir = dataset
+            self._cache_size = cache_size
+            self._local_cache_dir = local_cache_dir
+
+        self._indices = None
+        if indices is not None:
+            self._indices = np.asarray(indices, dtype=np.int64).ravel()
+        self._field_names = None
+        if field_names is not None:
+            self._field_names = list(field_names)
+        self._transforms = {}
+        if transforms is not None:
+            self._transforms = dict(transforms)
+
+        for field_name in self._transforms.keys():
+            if self._field_names is not None and field_name not in self._field_names:
+                raise ValueError('Transform for field %s, which is not in the view' %(field_name))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        return state
+
+    @property
+    def dataset(self):
+        """ Returns the underlying TensorDataset, opening it if necessary. """
+        if self._dataset is None:
+            self._dataset = TensorDataset.open(self._dataset_dir, cache_size=self._cache_size,
+                                               local_cache_dir=self._local_cache_dir)
+        return self._dataset
+
+    @property
+    def indices(self):
+        """ Returns the global indices of the datapoints in the view. """
+        if self._indices is None:
+            return self.dataset.datapoint_indices
+        return self._indices
+
+    @property
+    def num_datapoints(self):
+        if self._indices is None:
+            return self.dataset.num_datapoints
+        return self._indices.shape[0]
+
+    def __len__(self):
+        return self.num_datapoints
+
+    @property
+    def datapoint_indices(self):
+        """ Returns an array of all local indices of the view. """
+        return np.arange(self.num_datapoints)
+
+    @property
+    def datapoints_per_file(self):
+        return self.dataset.datapoints_per_file
+
+    @property
+    def field_names(self):
+        if self._field_names is None:
+            return self.dataset.field_names
+        return list(self._field_names)
+
+    @property
+    def transforms(self):
+        return dict(self._transforms)
+
+    def global_indices(self, indices):
+        """ Converts local indices of the view to global indices of the dataset. """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self._indices is None:
+            return indices
+        if indices.size > 0 and (indices.max() >= self._indices.shape[0] or indices.min() < 0):
+            raise ValueError('Indices must be in the range [0, %d)' %(self._indices.shape[0]))
+        return self._indices[indices]
+
+    def view(self, indices=None, field_names=None, transforms=None):
+        """ Returns a view of a subset of this view.
+
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            local indices of the datapoints of this view to keep, in order (None for all)
+        field_names : :obj:`list` of str
+            fields to keep, which must be in this view (None for all)
+        transforms : dict
+            mapping from field name to a function applied after the transforms of this view
+
+        Returns
+        -------
+        :obj:`TensorDatasetView`
+            the new view
+        """
+        if indices is not None:
+            indices = self.global_indices(indices)
+        elif self._indices is not None:
+            indices = self._indices
+        if field_names is not None:
+            for field_name in field_names:
+                if field_name not in self.field_names:
+                    raise ValueError('Field %s not in view' %(field_name))
+        else:
+            field_names = self._field_names
+
+        # chain the new transforms after the existing ones, dropping those of removed fields
+        combined_transforms = {}
+        for field_name, transform in self._transforms.items():
+            if field_names is None or field_name in field_names:
+                combined_transforms[field_name] = transform
+        if transforms is not None:
+            for field_name, transform in transforms.items():
+                if field_name in combined_transforms:
+                    transform = ChainedTransform(combined_transforms[field_name], transform)
+                combined_transforms[field_name] = transform
+
+        view = TensorDatasetView(self._dataset_dir, indices=indices, field_names=field_names,
+                                 transforms=combined_transforms, cache_size=self._cache_size,
+                                 local_cache_dir=self._local_cache_dir)
+        view._dataset = self._dataset
+        return view
+
+    def __getitem__(self, inds):
+        """ Returns the datapoint at a local index, or a view for a slice or an array of local indices. """
+        if isinstance(inds, slice):
+            if self._indices is None:
+                return self.view(np.arange(self.num_datapoints)[inds])
+            view = self.view()
+            view._indices = self._indices[inds]
+            return view
+        if np.isscalar(inds):
+            return self.datapoint(inds)
+        return self.view(inds)
+
+    def datapoints(self, indices, field_names=None):
+        """ Loads a batch of datapoints for the given local indices,
+        in the layout returned by TensorDataset.datapoints.
+
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            local indices in the view, in the order they should be returned
+        field_names : :obj:`list` of str
+            field names to load (None for all fields of the view)
+
+        Returns
+        -------
+        dict
+            mapping from field name to an array of stacked datapoints
+        """
+        if field_names is None:
+            field_names = self.field_names
+        elif self._field_names is not None:
+            for field_name in field_names:
+                if field_name not in self._field_names:
+                    raise ValueError('Field %s not in view' %(field_name))
+        batch = self.dataset.datapoints(self.global_indices(indices), field_names=field_names)
+        for field_name, transform in self._transforms.items():
+            if field_name in batch:
+                batch[field_name] = transform(batch[field_name])
+        return batch
+
+    def get_item_list(self, indices, field_names=None):
+        """ Loads a training batch for the given local indices,
+        in the layout returned by TensorDataset.get_item_list.
+
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            local indices of the datapoints in the batch
+        field_names : :obj:`list` of str
+            field names to load (None for the fields of the view used in training)
+
+        Returns
+        -------
+        dict
+            mapping from field name to the stacked values for the batch
+        """
+        if field_names is None:
+            field_names = [field_name for field_name in ITEM_LIST_FIELD_NAMES
+                           if field_name in self.field_names]
+        return TensorDataset.to_item_list(self.datapoints(indices, field_names=field_names))
+
+    def datapoint(self, ind, field_names=None):
+        """ Loads the datapoint at a local index. """
+        batch = self.datapoints([ind], field_names=field_names)
+        datapoint = TensorDatapoint(list(batch.keys()))
+        for field_name, value in batch.items():
+            datapoint[field_name] = value[0]
+        return datapoint
+
+class ChainedTransform(object):
+    """ Applies several transforms in order, and can be pickled if they can. """
+    def __init__(self, *transforms):
+        self._transforms = transforms
+
+    def __call__(self, value):
+        for transform in self._transforms:
+            value = transform(value)
+        return value
@@ -0,0 +1,324 @@
+"""
+Export of a TensorDataset to a single chunked HDF5 file, and a reader for it with the read API
+of TensorDataset. One file per dataset avoids the per-file metadata round trips of opening
+thousands of tensor files on network storage.
+
+Example usage:
+    export_hdf5(TensorDataset.open(dataset_dir), dataset_dir + '.h5', chunk_datapoints=64)
+    dataset = HDF5TensorDataset(dataset_dir + '.h5')
+    batch = dataset.get_item_list(dataset.split('train')[0][:64])
+
+Requires h5py.
+"""
+import copy
+import json
+import os
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+from autolab_core.constants import WRITE_ACCESS
+from .tensor_dataset import (TensorDataset, Tensor, TensorCache, TensorDatapoint, DEFAULT_CACHE_SIZE,
+                             COMPRESSED_TENSOR_FORMAT, RAW_TENSOR_FORMAT, ITEM_LIST_FIELD_NAMES,
+                             parse_field_specs, dense_field_specs, decode_field, gather_datapoints)
+
+HDF5_COMPRESSIONS = ['gzip', 'lzf', None]
+
+def _check_h5py():
+    if h5py is None:
+        raise ImportError('h5py is required to read and write HDF5 datasets')
+
+def export_hdf5(dataset, filename, chunk_datapoints=None, compression='gzip', compression_opts=4, shuffle=True):
+    """ Writes a tensor dataset, with its metadata and splits, to a single HDF5 file.
+    Fields are stored in their storage dtype, with one HDF5 dataset per field chunked
+    along the datapoint axis. Fields using a codec are stored densely, and the codec
+    is applied again by import_hdf5.
+
+    Parameters
+    ----------
+    dataset : :obj:`TensorDataset`
+        the dataset to export
+    filename : str
+        path to the HDF5 file, which must not exist yet
+    chunk_datapoints : int
+        number of datapoints per HDF5 chunk (None for the datapoints per file of the dataset).
+        Every read decompresses whole chunks, so smaller chunks suit random access
+    compression : str
+        HDF5 compression filter ('gzip', 'lzf' or None)
+    compression_opts : int
+        compression level for gzip (0-9)
+    shuffle : bool
+        whether to apply the byte shuffle filter before compression, which helps integer depth images
+    """
+    _check_h5py()
+    if compression not in HDF5_COMPRESSIONS:
+        raise ValueError('Compression %s not supported! Must be one of %s' %(compression, HDF5_COMPRESSIONS))
+    if os.path.exists(filename):
+        raise ValueError('File %s already exists!' %(filename))
+    if chunk_datapoints is None:
+        chunk_datapoints = dataset.datapoints_per_file
+    if chunk_datapoints <= 0:
+        raise ValueError('Chunk size must be positive')
+    if compression != 'gzip':
+        compression_opts = None
+
+    config = copy.deepcopy(dict([(key, dataset.config[key]) for key in dataset.config.keys()]))
+    num_datapoints = dataset.num_datapoints
+    with h5py.File(filename, 'w') as f:
+        f.attrs['config'] = json.dumps(config)
+        f.attrs['metadata'] = json.dumps(dataset.metadata)
+        f.attrs['num_datapoints'] = num_datapoints
+        f.attrs['chunk_datapoints'] = chunk_datapoints
+
+        # copy the stored values of each field tensor file by tensor file
+        fields = f.create_group('fields')
+        for field_name in dataset.field_names:
+            tensor = dataset.tensors[field_name]
+            shape = (num_datapoints,) + tensor.shape[1:]
+            chunks = None
+            if num_datapoints > 0:
+                chunks = (min(chunk_datapoints, num_datapoints),) + tensor.shape[1:]
+            fields.create_dataset(field_name, shape=shape, dtype=tensor.dtype, chunks=chunks,
+                                  compression=compression, compression_opts=compression_opts,
+                                  shuffle=shuffle and compression is not None)
+        for tensor_ind in range(dataset.num_tensors):
+            start = tensor_ind * dataset.datapoints_per_file
+            for field_name in dataset.field_names:
+                tensor = dataset.load_tensor(field_name, tensor_ind)
+                values = tensor.data_slice(np.arange(tensor.size))
+                fields[field_name][start:start + values.shape[0]] = values
+
+        # copy the splits
+        splits = f.create_group('splits')
+        if os.path.exists(dataset.split_dir):
+            for split_name in dataset.split_names:
+                train_indices, val_indices, split_metadata = dataset.split(split_name)
+                split = splits.create_group(split_name)
+                split.create_dataset('train_indices', data=train_indices)
+                split.create_dataset('val_indices', data=val_indices)
+                split.attrs['metadata'] = json.dumps(split_metadata)
+
+def import_hdf5(filename, output_dir, tensor_format=COMPRESSED_TENSOR_FORMAT):
+    """ Writes the contents of an HDF5 file created by export_hdf5 back to a tensor dataset.
+
+    Parameters
+    ----------
+    filename : str
+        path to the HDF5 file
+    output_dir : str
+        path to the new dataset, which must not exist yet
+    tensor_format : str
+        on-disk format of the tensors ('npz' or 'npy')
+
+    Returns
+    -------
+    :obj:`TensorDataset`
+        the imported dataset, opened read-only
+    """
+    _check_h5py()
+    if os.path.exists(output_dir):
+        raise ValueError('Dataset %s already exists!' %(output_dir))
+    with h5py.File(filename, 'r') as f:
+        config = json.loads(f.attrs['config'])
+        config['format'] = tensor_format
+        if tensor_format == RAW_TENSOR_FORMAT:
+            # codecs need the compressed format, so store every field densely
+            config['fields'] = dense_field_specs(config['fields'])
+        output_dataset = TensorDataset(output_dir, config, access_mode=WRITE_ACCESS)
+        num_datapoints = int(f.attrs['num_datapoints'])
+        datapoints_per_file = output_dataset.datapoints_per_file
+
+        # write the stored values of each field file by file
+        for tensor_ind, start in enumerate(range(0, num_datapoints, datapoints_per_file)):
+            end = min(start + datapoints_per_file, num_datapoints)
+            for field_name in output_dataset.field_names:
+                template = output_dataset.tensors[field_name]
+                tensor = Tensor(template.shape, template.dtype, data=f['fields'][field_name][start:end])
+                output_dataset.save_tensor(field_name, tensor_ind, tensor)
+
+        # write the metadata, index and splits
+        output_dataset._metadata = json.loads(f.attrs['metadata'])
+        output_dataset._save_metadata(num_datapoints)
+        output_dataset._save_index()
+        for split_name, split in f['splits'].items():
+            os.makedirs(os.path.join(output_dataset.split_dir, split_name))
+            np.savez_compressed(output_dataset.train_indices_filename(split_name), split['train_indices'][()])
+            np.savez_compressed(output_dataset.val_indices_filename(split_name), split['val_indices'][()])
+            with open(output_dataset.split_metadata_filename(split_name), 'w') as split_metadata_file:
+                split_metadata_file.write(split.attrs['metadata'])
+    return TensorDataset.open(output_dir)
+
+class HDF5TensorDataset(object):
+    """ Read-only dataset stored in an HDF5 file written by export_hdf5, with the read methods
+    of TensorDataset. Each HDF5 chunk plays the role of a tensor file: loaded chunks are kept in
+    a per-field LRU cache of cache_size bytes, datapoints_per_file is the number of datapoints
+    per chunk (for ChunkBatchSampler), and the dataset can be read with TensorDatasetPrefetcher.
+
+    The file is opened lazily in each process, so the dataset can be pickled to worker processes.
+    """
+    def __init__(self, filename, cache_size=DEFAULT_CACHE_SIZE):
+        _check_h5py()
+        self._filename = filename
+        self._cache_size = cache_size
+        self._file = None
+        with h5py.File(filename, 'r') as f:
+            self._config = json.loads(f.attrs['config'])
+            self._metadata = json.loads(f.attrs['metadata'])
+            self._num_datapoints = int(f.attrs['num_datapoints'])
+            self._chunk_datapoints = int(f.attrs['chunk_datapoints'])
+            self._field_names = list(f['fields'].keys())
+            self._split_names = list(f['splits'].keys())
+            self._shapes = dict([(field_name, f['fields'][field_name].shape[1:]) for field_name in self._field_names])
+
+        # read the dtype of each field and the dtype it is stored in (codecs are not used in the file)
+        self._field_dtypes, self._storage_dtypes, self._field_scales, _ = parse_field_specs(self._config['fields'])
+        self._tensor_caches = dict([(field_name, TensorCache(cache_size)) for field_name in self._field_names])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_tensor_caches'] = dict([(field_name, TensorCache(self._cache_size)) for field_name in self._field_names])
+        return state
+
+    @property
+    def file(self):
+        """ Returns the open HDF5 file, opening it if necessary. """
+        if self._file is None:
+            self._file = h5py.File(self._filename, 'r')
+        return self._file
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def metadata(self):
+        return self._metadata
+
+    @property
+    def num_datapoints(self):
+        return self._num_datapoints
+
+    @property
+    def num_tensors(self):
+        return -(-self._num_datapoints // self._chunk_datapoints)
+
+    @property
+    def datapoints_per_file(self):
+        return self._chunk_datapoints
+
+    @property
+    def field_names(self):
+        return list(self._field_names)
+
+    @property
+    def datapoint_indices(self):
+        """ Returns an array of all dataset indices. """
+        return np.arange(self._num_datapoints)
+
+    @property
+    def split_names(self):
+        return list(self._split_names)
+
+    def has_split(self, split_name):
+        return split_name in self._split_names
+
+    def split(self, split_name):
+        """ Return the training indices, validation indices and metadata of the requested split. """
+        if not self.has_split(split_name):
+            raise ValueError('Split %s does not exist!' %(split_name))
+        split = self.file['splits'][split_name]
+        return split['train_indices'][()], split['val_indices'][()], json.loads(split.attrs['metadata'])
+
+    def _decode(self, field_name, value):
+        """ Converts a stored value of a field back to the dtype of the field. """
+        return decode_field(value, self._field_dtypes[field_name], self._storage_dtypes[field_name], self._field_scales[field_name])
+
+    def load_tensor(self, field_name, tensor_ind):
+        """ Reads the stored values of a field for the datapoints of a chunk. """
+        start = tensor_ind * self._chunk_datapoints
+        return self.file['fields'][field_name][start:start + self._chunk_datapoints]
+
+    def is_cached(self, field_name, tensor_ind):
+        """ Checks whether a chunk is in the cache. """
+        return tensor_ind in self._tensor_caches[field_name]
+
+    def cache_tensor(self, field_name, tensor_ind, tensor):
+        """ Adds a chunk loaded with load_tensor to the cache. """
+        self._tensor_caches[field_name].put(tensor_ind, tensor)
+
+    def tensor(self, field_name, tensor_ind):
+        """ Returns the stored values of a field for a chunk, reading it if it is not cached. """
+        tensor = self._tensor_caches[field_name].get(tensor_ind)
+        if tensor is None:
+            tensor = self.load_tensor(field_name, tensor_ind)
+            self.cache_tensor(field_name, tensor_ind, tensor)
+        return tensor
+
+    @property
+    def cache_stats(self):
+        """ Returns the hit, miss and eviction counters of the chunk cache for each field. """
+        return dict([(field_name, cache.stats) for field_name, cache in self._tensor_caches.items()])
+
+    def clear_cache(self):
+        """ Empties the chunk cache of every field. """
+        for cache in self._tensor_caches.values():
+            cache.clear()
+
+    def datapoints(self, indices, field_names=None):
+        """ Loads a batch of datapoints for the given global indices, reading each chunk once.
+
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            global indices in the dataset, in the order they should be returned
+        field_names : :obj:`list` of str
+            field names to load
+
+        Returns
+        -------
+        dict
+            mapping from field name to an array of stacked datapoints
+        """
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if indices.shape[0] > 0 and (indices.max() >= self._num_datapoints or indices.min() < 0):
+            raise ValueError('Indices must be in the range [0, %d)' %(self._num_datapoints))
+        if field_names is None:
+            field_names = self.field_names
+
+        def read_values(field_name, chunk_num, chunk_indices):
+            return self._decode(field_name, self.tensor(field_name, chunk_num)[chunk_indices])
+        return gather_datapoints(indices, self._chunk_datapoints, field_names, self._shapes, self._field_dtypes, read_values)
+
+    def get_item_list(self, indices, field_names=None):
+        """ Loads a training batch for the given global indices, in the layout of TensorDataset.get_item_list. """
+        if field_names is None:
+            field_names = ITEM_LIST_FIELD_NAMES
+        return TensorDataset.to_item_list(self.datapoints(indices, field_names=field_names))
+
+    def datapoint(self, ind, field_names=None):
+        """ Loads the datapoint at a global index. """
+        batch = self.datapoints([ind], field_names=field_names)
+        datapoint = TensorDatapoint(list(batch.keys()))
+        for field_name, value in batch.items():
+            datapoint[field_name] = value[0]
+        return datapoint
+
+    def column(self, field_name):
+        """ Loads the values of a single field for every datapoint. """
+        if field_name not in self._field_names:
+            raise ValueError('Field %s not specified in dataset' %(field_name))
+        return self._decode(field_name, self.file['fields'][field_name][()])
+
+    def close(self):
+        """ Closes the HDF5 file, which is reopened on the next read. """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -3,6 +3,40 @@ from unsupervised_rbt.losses import kornia
 import pickle 
 import numpy as np
 
+DEFAULT_CHAMFER_TILE_SIZE = 64
+
+def nearest_indices(x, y, tile_size=None):
+    """For each point of x = (batch,n,3), returns the index of the closest point of y = (batch,m,3),
+    as a (batch,n) tensor. Distances are computed for tile_size points of x at a time,
+    so at most batch*m*tile_size*3 floats are materialized instead of batch*m*n*3."""
+    if tile_size is None:
+        tile_size = DEFAULT_CHAMFER_TILE_SIZE
+    indices = []
+    with torch.no_grad():
+        for start in range(0, x.size(1), tile_size):
+            x_y = torch.unsqueeze(x[:,start:start+tile_size], 1) - torch.unsqueeze(y, 2)  # x_y = batch,m,tile,3
+            x_y = torch.sum(torch.pow(x_y, 2), 3)  # x_y = batch,m,tile
+            _, tile_indices = torch.min(x_y, 1)  # tile_indices = batch,tile
+            indices.append(tile_indices)
+    return torch.cat(indices, 1)
+
+def chamfer_distance(x, y, tile_size=None):
+    """One-sided chamfer distance: the mean over the batch of the mean squared distance
+    from each point of x = (batch,n,3) to its closest point in y = (batch,m,3).
+    The closest points are found tile by tile without gradients, then the distances to them are
+    recomputed from the gathered points. This gives the same value and gradients as the min over
+    the full batch,m,n distance tensor, and autograd only keeps batch*n*3 floats for backward."""
+    x_size = x.size()
+    y_size = y.size()
+    assert (x_size[0] == y_size[0])
+    assert (x_size[2] == y_size[2])
+    indices = nearest_indices(x, y, tile_size)
+    nearest = torch.gather(y, 1, torch.unsqueeze(indices, 2).expand(-1, -1, y_size[2]))  # nearest = batch,n,3
+    x_y_row = torch.sum(torch.pow(x - nearest, 2), 2)  # x_y_row = batch,n
+    chamfer_distance = torch.mean(x_y_row, 1)  # batch
+    chamfer_distance = torch.mean(chamfer_distance) # loss
+    return chamfer_distance
+
 class ShapeMatchLoss(torch.nn.Module):
     """
     Shape-Match Loss function.
@@ -13,28 +47,9 @@ class ShapeMatchLoss(torch.nn.Module):
         super(ShapeMatchLoss, self).__init__()
 
     @staticmethod
-    def PointCloudDistance(x,y): # for example, x = (batch,2025,3), y = (batch,2048,3) ONLY works if # points in point cloud is the same across batches
-        # code from https://github.com/YanWei123/Pytorch-implementation-of-FoldingNet-encoder-and-decoder-with-graph-pooling-covariance-add-quanti
+    def PointCloudDistance(x, y, tile_size=None): # for example, x = (batch,2025,3), y = (batch,2048,3) ONLY works if # points in point cloud is the same across batches
         """x is ground truth point cloud, y is rotated point cloud"""
-        x_size = x.size() 
-        y_size = y.size()
-        assert (x_size[0] == y_size[0])
-        assert (x_size[2] == y_size[2])
-        x = torch.unsqueeze(x, 1)  # x = batch,1,2025,3
-        y = torch.unsqueeze(y, 2)  # y = batch,2048,1,3
-
-        x = x.repeat(1, y_size[1], 1, 1)  # x = batch,2048,2025,3
-        y = y.repeat(1, 1, x_size[1], 1)  # y = batch,2048,2025,3
-
-        x_y = x - y
-        x_y = torch.pow(x_y, 2)  # x_y = batch,2048,2025,3
-        x_y = torch.sum(x_y, 3, keepdim=True)  # x_y = batch,2048,2025,1
-        x_y = torch.squeeze(x_y, 3)  # x_y = batch,2048,2025
-        x_y_row, _ = torch.min(x_y, 1)  # x_y_row = batch,2025
-        # print(x_y_row)
-        chamfer_distance = torch.mean(x_y_row, 1)  # batch
-        chamfer_distance = torch.mean(chamfer_distance) # loss
-        return chamfer_distance
+        return chamfer_distance(x, y, tile_size)
 
     def forward(self, predquat, gtquat, points, lambd = 0.08): # points should be of shape (batch x 3 x npoints)
         predrot = kornia.quaternion_to_rotation_matrix(predquat)
@@ -61,28 +76,9 @@ class ShapeMatchLoss_Lie(torch.nn.Module):
         super(ShapeMatchLoss_Lie, self).__init__()
 
     @staticmethod
-    def PointCloudDistance(x,y): # for example, x = (batch,2025,3), y = (batch,2048,3) ONLY works if # points in point cloud is the same across batches
-        # code from https://github.com/YanWei123/Pytorch-implementation-of-FoldingNet-encoder-and-decoder-with-graph-pooling-covariance-add-quanti
+    def PointCloudDistance(x, y, tile_size=None): # for example, x = (batch,2025,3), y = (batch,2048,3) ONLY works if # points in point cloud is the same across batches
         """x is ground truth point cloud, y is rotated point cloud"""
-        x_size = x.size()
-        y_size = y.size()
-        assert (x_size[0] == y_size[0])
-        assert (x_size[2] == y_size[2])
-        x = torch.unsqueeze(x, 1)  # x = batch,1,2025,3
-        y = torch.unsqueeze(y, 2)  # y = batch,2048,1,3
-
-        x = x.repeat(1, y_size[1], 1, 1)  # x = batch,2048,2025,3
-        y = y.repeat(1, 1, x_size[1], 1)  # y = batch,2048,2025,3
-
-        x_y = x - y
-        x_y = torch.pow(x_y, 2)  # x_y = batch,2048,2025,3
-        x_y = torch.sum(x_y, 3, keepdim=True)  # x_y = batch,2048,2025,1
-        x_y = torch.squeeze(x_y, 3)  # x_y = batch,2048,2025
-        x_y_row, _ = torch.min(x_y, 1)  # x_y_row = batch,2025
-        # print(x_y_row)
-        chamfer_distance = torch.mean(x_y_row, 1)  # batch
-        chamfer_distance = torch.mean(chamfer_distance) # loss
-        return chamfer_distance
+        return chamfer_distance(x, y, tile_size)
 
     def forward(self, predrot, gtrot, points, lambd = 0.08): # points should be of shape (batch x 3 x npoints)
         predrot = kornia.angle_axis_to_rotation_matrix(predrot)
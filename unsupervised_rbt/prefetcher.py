@@ -0,0 +1,107 @@
+"""
+Prefetching reader for iterating over a TensorDataset in a fixed order.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .tensor_dataset import ITEM_LIST_FIELD_NAMES
+from .dataset_view import TensorDatasetView
+
+class TensorDatasetPrefetcher(object):
+    """ Iterates over batches of a TensorDataset in a given order, decompressing the
+    tensor files needed by upcoming batches on a pool of background threads so that
+    loading overlaps with whatever the caller does with the current batch.
+
+    At most num_prefetch tensor files ahead of the current batch are loaded, and
+    loaded tensors are handed to the dataset cache on the calling thread, so the
+    dataset itself is never modified concurrently.
+
+    A TensorDatasetView can be read in the same way, with indices local to the view.
+    """
+    def __init__(self, dataset, indices, batch_size, field_names=None,
+                 num_workers=4, num_prefetch=4, drop_last=False):
+        """
+        Parameters
+        ----------
+        dataset : :obj:`TensorDataset` or :obj:`TensorDatasetView`
+            dataset or view to read from
+        indices : :obj:`list` of int
+            indices of the datapoints in the dataset or view, in the order they should be read
+        batch_size : int
+            number of datapoints per batch
+        field_names : :obj:`list` of str
+            field names to load (None for the fields returned by get_item_list)
+        num_workers : int
+            number of background threads
+        num_prefetch : int
+            maximum number of tensor files being loaded ahead of the current batch
+        drop_last : bool
+            whether to skip the last batch if it is smaller than batch_size
+        """
+        if batch_size <= 0:
+            raise ValueError('Batch size must be positive')
+        self._dataset = dataset
+        self._indices = np.asarray(indices, dtype=np.int64).ravel()
+        self._batch_size = batch_size
+        self._field_names = field_names
+        if field_names is None:
+            self._field_names = ITEM_LIST_FIELD_NAMES
+            if isinstance(dataset, TensorDatasetView):
+                self._field_names = [field_name for field_name in ITEM_LIST_FIELD_NAMES
+                                     if field_name in dataset.field_names]
+        self._num_workers = num_workers
+        self._num_prefetch = num_prefetch
+        self._drop_last = drop_last
+
+    def __len__(self):
+        num_batches = self._indices.shape[0] // self._batch_size
+        if not self._drop_last and self._indices.shape[0] % self._batch_size > 0:
+            num_batches += 1
+        return num_batches
+
+    def _batch_indices(self, batch_num):
+        """ Returns the global indices of the datapoints in the given batch. """
+        return self._indices[batch_num*self._batch_size: (batch_num+1)*self._batch_size]
+
+    def __iter__(self):
+        """ Yields the batches as returned by TensorDataset.get_item_list. """
+        # files are loaded into the cache of the underlying dataset of a view
+        dataset = self._dataset
+        global_indices = self._indices
+        if isinstance(dataset, TensorDatasetView):
+            global_indices = dataset.global_indices(self._indices)
+            dataset = dataset.dataset
+        datapoints_per_file = dataset.datapoints_per_file
+        num_batches = len(self)
+        batch_file_nums = [np.unique(global_indices[i*self._batch_size: (i+1)*self._batch_size]
+                                     // datapoints_per_file) for i in range(num_batches)]
+
+        executor = ThreadPoolExecutor(max_workers=self._num_workers)
+        pending = {}
+        next_batch_to_submit = 0
+        try:
+            for batch_num in range(num_batches):
+                # queue the files of upcoming batches, always including the current one
+                while next_batch_to_submit < num_batches and \
+                      (next_batch_to_submit <= batch_num or
+                       len(set(file_num for _, file_num in pending)) < self._num_prefetch):
+                    for file_num in batch_file_nums[next_batch_to_submit]:
+                        for field_name in self._field_names:
+                            key = (field_name, file_num)
+                            if key not in pending and not dataset.is_cached(field_name, file_num):
+                                pending[key] = executor.submit(dataset.load_tensor, field_name, file_num)
+                    next_batch_to_submit += 1
+
+                # move the loaded files of the current batch into the dataset cache
+                for file_num in batch_file_nums[batch_num]:
+                    for field_name in self._field_names:
+                        future = pending.pop((field_name, file_num), None)
+                        if future is not None:
+                            dataset.cache_tensor(field_name, file_num, future.result())
+
+                yield self._dataset.get_item_list(self._batch_indices(batch_num),
+                                                  field_names=self._field_names)
+        finally:
+            for future in pending.values():
+                future.cancel()
+            executor.shutdown(wait=False)
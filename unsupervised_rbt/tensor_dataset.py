@@ -24,12 +24,17 @@ Classes for efficiently storing datasets containing several attributes of differ
 Designed for saving TensorFlow training datasets.
 Author: Jeff Mahler
 """
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import json
 import logging
 import numpy as np
 import os
 import shutil
 import sys
+import threading
+import zlib
 
 from autolab_core.constants import *
 from autolab_core.utils import *
@@ -37,6 +42,14 @@ from autolab_core import YamlConfig, transformations
 
 TENSOR_EXT = '.npy'
 COMPRESSED_TENSOR_EXT = '.npz'
+COMPRESSED_TENSOR_FORMAT = 'npz' # zlib-compressed chunks, each read inflates the whole chunk
+RAW_TENSOR_FORMAT = 'npy' # uncompressed chunks, read through memory maps
+TENSOR_FORMATS = [COMPRESSED_TENSOR_FORMAT, RAW_TENSOR_FORMAT]
+BBOX_CODEC = 'bbox' # images stored as the bounding box of their nonzero pixels
+TENSOR_CODECS = [BBOX_CODEC]
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024 # bytes per field
+INDEX_VERSION = 1
+ITEM_LIST_FIELD_NAMES = ["depth_image1", "depth_image2", "quaternion", "lie", "pose_matrix", "obj_id"]
 
 class Tensor(object):
     """ Abstraction for 4-D tensor objects with a fixed allocation size. 
@@ -93,6 +106,10 @@ class Tensor(object):
     def has_data(self):
         return self.cur_index > 0
 
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
     def __getitem__(self, i):
         return self.datapoint(i)
 
@@ -148,7 +165,7 @@ class Tensor(object):
         """ Sets the value of the datapoint at the given index. """
         if ind >= self.num_datapoints:
             raise ValueError('Index %d out of bounds! Tensor has %d datapoints' %(ind, self.num_datapoints))
-        self.data[ind, ...] = np.array(datapoint).astype(self.dtype)
+        self.data[ind, ...] = np.asarray(datapoint, dtype=self.dtype)
             
     def data_slice(self, slice_ind):
         """ Returns a slice of datapoints """
@@ -176,8 +193,11 @@ class Tensor(object):
         return True
 
     @staticmethod
-    def load(filename, compressed=True, prealloc=None):
-        """ Loads a tensor from disk. """
+    def load(filename, compressed=True, prealloc=None, mmap=False):
+        """ Loads a tensor from disk.
+        Uncompressed tensors can be memory-mapped read-only with mmap=True,
+        so that only the rows that are accessed are read from disk.
+        """
         # switch load based on file ext
         _, file_ext = os.path.splitext(filename)
         if compressed:
@@ -187,7 +207,10 @@ class Tensor(object):
         else:
             if file_ext != TENSOR_EXT:
                 raise ValueError('Can only load tensor with .npy extension')
-            data = np.load(filename)
+            mmap_mode = None
+            if mmap:
+                mmap_mode = 'r'
+            data = np.load(filename, mmap_mode=mmap_mode)
             
         # fill prealloc tensor
         if prealloc is not None:
@@ -195,10 +218,282 @@ class Tensor(object):
             prealloc.add_batch(data)
             return prealloc
             
-        # init new tensor
-        tensor = Tensor(data.shape, data.dtype, data=data)
+        # init new tensor around the loaded data without copying it
+        tensor = Tensor((0,) + data.shape[1:], data.dtype)
+        tensor.data = data
+        tensor.cur_index = data.shape[0]
         return tensor
 
+class BBoxImageTensor(object):
+    """ Read-only tensor of images stored as the bounding box of the nonzero pixels of each image,
+    for images that are mostly zero background. The cropped boxes are stored back to back in a
+    flat array, and images are only expanded to full size when they are read.
+    """
+    def __init__(self, bboxes, offsets, values, shape):
+        self.bboxes = bboxes
+        self.offsets = offsets
+        self.values = values
+        self.dtype = values.dtype
+        self._shape = tuple(shape)
+
+    @property
+    def size(self):
+        return self.bboxes.shape[0]
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nbytes(self):
+        return self.bboxes.nbytes + self.offsets.nbytes + self.values.nbytes
+
+    @staticmethod
+    def encode(data):
+        """ Crops each image of a batch (axis 0) to the bounding box of its nonzero pixels. """
+        data = np.asarray(data)
+        num_images, height, width = data.shape[:3]
+        nonzero = data != 0
+        if nonzero.ndim > 3:
+            nonzero = nonzero.reshape(num_images, height, width, -1).any(axis=3)
+        nonzero_rows = nonzero.any(axis=2)
+        nonzero_cols = nonzero.any(axis=1)
+        bboxes = np.zeros((num_images, 4), dtype=np.int32)
+        bboxes[:, 0] = np.argmax(nonzero_rows, axis=1)
+        bboxes[:, 1] = height - np.argmax(nonzero_rows[:, ::-1], axis=1)
+        bboxes[:, 2] = np.argmax(nonzero_cols, axis=1)
+        bboxes[:, 3] = width - np.argmax(nonzero_cols[:, ::-1], axis=1)
+        bboxes[~nonzero_rows.any(axis=1)] = 0
+
+        crops = [data[i, r0:r1, c0:c1, ...].ravel() for i, (r0, r1, c0, c1) in enumerate(bboxes)]
+        crop_sizes = [crop.shape[0] for crop in crops]
+        offsets = np.zeros(num_images + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(crop_sizes)
+        values = np.zeros(0, dtype=data.dtype)
+        if num_images > 0:
+            values = np.concatenate(crops)
+        return BBoxImageTensor(bboxes, offsets, values, data.shape)
+
+    def data_slice(self, slice_ind):
+        """ Returns the full-size images at the given indices. """
+        slice_ind = np.arange(self.size)[slice_ind]
+        images = np.zeros((np.size(slice_ind),) + self._shape[1:], dtype=self.dtype)
+        for i, ind in enumerate(np.atleast_1d(slice_ind)):
+            r0, r1, c0, c1 = self.bboxes[ind]
+            images[i, r0:r1, c0:c1, ...] = self.values[self.offsets[ind]:self.offsets[ind+1]].reshape(
+                (r1 - r0, c1 - c0) + self._shape[3:])
+        if np.ndim(slice_ind) == 0:
+            return images[0]
+        return images
+
+    def datapoint(self, ind):
+        """ Returns the full-size image at the given index. """
+        return self.data_slice(ind)
+
+    def dense(self, prealloc=None):
+        """ Expands all images into a Tensor (or the given preallocated tensor). """
+        data = self.data_slice(np.arange(self.size))
+        if prealloc is not None:
+            prealloc.reset()
+            prealloc.add_batch(data)
+            return prealloc
+        tensor = Tensor((0,) + self._shape[1:], self.dtype)
+        tensor.data = data
+        tensor.cur_index = data.shape[0]
+        return tensor
+
+    def save(self, filename, compressed=True):
+        """ Save the encoded images to disk. """
+        if self.size == 0:
+            return False
+        _, file_ext = os.path.splitext(filename)
+        if not compressed or file_ext != COMPRESSED_TENSOR_EXT:
+            raise ValueError('Can only save bbox-encoded tensor compressed with %s extension' %(COMPRESSED_TENSOR_EXT))
+        np.savez_compressed(filename, bboxes=self.bboxes, offsets=self.offsets,
+                            values=self.values, shape=np.array(self._shape))
+        return True
+
+    @staticmethod
+    def load(filename):
+        """ Loads bbox-encoded images from disk. """
+        data = np.load(filename)
+        return BBoxImageTensor(data['bboxes'], data['offsets'], data['values'], data['shape'])
+
+def write_json_atomic(obj, filename):
+    """ Writes an object as json to a temporary file and renames it to filename,
+    so that readers see either the previous file or the complete new one. """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as f:
+        json.dump(obj, f, indent=JSON_INDENT, sort_keys=True)
+    os.replace(temp_filename, filename)
+
+def file_checksum(filename, block_size=1024*1024):
+    """ Returns the CRC32 of the contents of a file. """
+    checksum = 0
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            checksum = zlib.crc32(block, checksum)
+    return checksum & 0xffffffff
+
+def parse_field_specs(field_specs):
+    """ Reads the dtype, storage dtype, scale and codec of each field of a dataset config.
+
+    Parameters
+    ----------
+    field_specs : dict
+        mapping from field name to field spec, as in the 'fields' entry of the config
+
+    Returns
+    -------
+    :obj:`tuple` of dict
+        mappings from field name to dtype, storage dtype, scale (or None) and codec (or None)
+    """
+    field_dtypes = {}
+    storage_dtypes = {}
+    field_scales = {}
+    field_codecs = {}
+    for field_name, field_spec in field_specs.items():
+        field_dtypes[field_name] = np.dtype(field_spec['dtype'])
+        storage_dtypes[field_name] = field_dtypes[field_name]
+        if 'storage_dtype' in field_spec.keys():
+            storage_dtypes[field_name] = np.dtype(field_spec['storage_dtype'])
+        field_scales[field_name] = None
+        if 'scale' in field_spec.keys():
+            if storage_dtypes[field_name].kind not in 'iu':
+                raise ValueError('Field %s must be stored in an integer dtype to use a scale' %(field_name))
+            field_scales[field_name] = field_spec['scale']
+        field_codecs[field_name] = None
+        if 'codec' in field_spec.keys():
+            if field_spec['codec'] not in TENSOR_CODECS:
+                raise ValueError('Codec %s not supported! Must be one of %s' %(field_spec['codec'], TENSOR_CODECS))
+            if 'width' not in field_spec.keys():
+                raise ValueError('Codec %s can only be used for image fields' %(field_spec['codec']))
+            field_codecs[field_name] = field_spec['codec']
+    return field_dtypes, storage_dtypes, field_scales, field_codecs
+
+def dense_field_specs(field_specs):
+    """ Returns a copy of the field specs of a config without codecs, for storing every field densely. """
+    return dict([(field_name, dict([(key, value) for key, value in field_spec.items() if key != 'codec']))
+                 for field_name, field_spec in field_specs.items()])
+
+def decode_field(value, field_dtype, storage_dtype, scale):
+    """ Converts a stored value of a field back to the dtype of the field. """
+    if storage_dtype == field_dtype:
+        return value
+    if scale is not None:
+        return (value / scale).astype(field_dtype)
+    return np.asarray(value).astype(field_dtype)
+
+def gather_datapoints(indices, datapoints_per_chunk, field_names, field_shapes, field_dtypes, read_values):
+    """ Gathers the datapoints at the given global indices from a dataset stored in chunks.
+    Indices are grouped by chunk so that each field is read with a single indexing operation per chunk.
+
+    Parameters
+    ----------
+    indices : :obj:`numpy.ndarray` of int
+        global indices in the dataset, in the order they should be returned
+    datapoints_per_chunk : int
+        number of datapoints in each chunk
+    field_names : :obj:`list` of str
+        field names to load
+    field_shapes : dict
+        mapping from field name to the shape of a datapoint
+    field_dtypes : dict
+        mapping from field name to the dtype of the field
+    read_values : function
+        called as read_values(field_name, chunk_num, chunk_indices) to return the decoded
+        values of a field at the given indices within a chunk
+
+    Returns
+    -------
+    dict
+        mapping from field name to an array of stacked datapoints
+    """
+    # allocate the output arrays
+    num_indices = indices.shape[0]
+    batch = {}
+    for field_name in field_names:
+        batch[field_name] = np.empty((num_indices,) + tuple(field_shapes[field_name]), dtype=field_dtypes[field_name])
+
+    # group the indices by chunk
+    chunk_nums = indices // datapoints_per_chunk
+    chunk_indices = indices % datapoints_per_chunk
+    order = np.argsort(chunk_nums, kind='mergesort')
+    unique_chunk_nums, starts = np.unique(chunk_nums[order], return_index=True)
+    ends = np.append(starts[1:], num_indices)
+
+    # gather each field once per chunk
+    for chunk_num, start, end in zip(unique_chunk_nums, starts, ends):
+        batch_inds = order[start:end]
+        for field_name in field_names:
+            batch[field_name][batch_inds] = read_values(field_name, chunk_num, chunk_indices[batch_inds])
+    return batch
+
+class TensorCache(object):
+    """ Least-recently-used cache of loaded tensors for a single field,
+    bounded by the total number of bytes of tensor data it holds.
+    The most recently added tensor is always kept, even if it exceeds the budget.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tensors = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._tensors)
+
+    def __contains__(self, tensor_ind):
+        return tensor_ind in self._tensors
+
+    @property
+    def stats(self):
+        """ Returns a dictionary of cache counters. """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'num_tensors': len(self._tensors),
+            'size': self.size,
+            'max_size': self.max_size
+        }
+
+    def get(self, tensor_ind):
+        """ Returns the cached tensor for the given index, or None on a miss. """
+        tensor = self._tensors.get(tensor_ind)
+        if tensor is None:
+            self.misses += 1
+            return None
+        self._tensors.move_to_end(tensor_ind)
+        self.hits += 1
+        return tensor
+
+    def put(self, tensor_ind, tensor):
+        """ Adds a tensor to the cache, evicting the least recently used tensors if necessary. """
+        self.remove(tensor_ind)
+        self._tensors[tensor_ind] = tensor
+        self.size += tensor.nbytes
+        while self.size > self.max_size and len(self._tensors) > 1:
+            _, evicted_tensor = self._tensors.popitem(last=False)
+            self.size -= evicted_tensor.nbytes
+            self.evictions += 1
+
+    def remove(self, tensor_ind):
+        """ Removes the tensor with the given index from the cache, if present. """
+        tensor = self._tensors.pop(tensor_ind, None)
+        if tensor is not None:
+            self.size -= tensor.nbytes
+
+    def clear(self):
+        """ Removes all tensors from the cache. """
+        self._tensors.clear()
+        self.size = 0
+
 class TensorDatapoint(dict):
     """ A single tensor datapoint.
     Basically acts like a dictionary.
@@ -218,17 +513,74 @@ class TensorDataset(object):
     The dataset can only be modified by appending a datapoint
     or removing the last datapoint, but can be read from any index at any time.
 
-    Under the hood, this class saves individual attributes in chunks as compressed NumPy files.
-    Thus, reads are most efficient when performed in order rather than randomly, to prevent
+    Under the hood, this class saves individual attributes in chunks as compressed NumPy files,
+    or as raw NumPy files that are memory-mapped on read if the config sets 'format' to 'npy'.
+    Loaded chunks are kept in a per-field LRU cache of cache_size bytes, but reads are still
+    most efficient when performed in order rather than randomly, to prevent
     expensive I/O to read a single datapoint.
+
+    A field can be stored in a smaller dtype than it is read in by setting 'storage_dtype'
+    in its config, e.g. uint16 for depth images. If the field also sets 'scale', values are
+    stored as fixed point, truncated to multiples of 1 / scale, and are decoded on read.
+
+    Image fields that are mostly zero can set 'codec' to 'bbox' to store only the bounding box
+    of the nonzero pixels of each image (compressed format only).
+
+    flush() also writes index.json, which records the number of rows, size, CRC32 checksum
+    and min/max/mean of every tensor file. verify() checks the files against it, and
+    opening the dataset uses it to find the number of datapoints.
+
+    With async_write=True, full chunks are saved by a background thread while new
+    datapoints are added to a second set of tensors. Errors from the background
+    thread are raised by the next call to add or flush.
+
+    A read-only dataset on network storage can be staged to a local_cache_dir: the first
+    read of each tensor file copies it to the local directory on a pool of background
+    threads, and once a copy matches the size and modification time of the source file,
+    the file is read from local disk. Each local copy is validated once per process.
     """
-    def __init__(self, filename, config, access_mode=WRITE_ACCESS):
+    def __init__(self, filename, config, access_mode=WRITE_ACCESS, cache_size=DEFAULT_CACHE_SIZE,
+                 async_write=False, local_cache_dir=None, num_local_copy_workers=4):
         # read params
         self._filename = filename
         self._config = config
         self._metadata = {}
+        self._index = {}
+        self._metadata_lock = threading.Lock() # guards the metadata and index, which the writer thread updates
         self._datapoints_per_file = config['datapoints_per_file']
         self._access_mode = access_mode
+        self._cache_size = cache_size
+        self._async_write = async_write
+        self._writer = None
+        self._pending_write = None
+        self._spare_tensors = None
+
+        # staging of tensor files to local disk
+        self._local_cache_dir = local_cache_dir
+        self._local_dataset_dir = None
+        self._local_copier = None
+        self._local_lock = threading.Lock() # guards the sets of staged files, which loading threads update
+        self._local_files = set()
+        self._local_copies = {}
+        if local_cache_dir is not None:
+            if access_mode != READ_ONLY_ACCESS:
+                raise ValueError('Datasets can only be staged to a local cache with read-only access')
+            self._local_dataset_dir = os.path.join(local_cache_dir, os.path.abspath(filename).strip(os.sep))
+            self._local_copier = ThreadPoolExecutor(max_workers=num_local_copy_workers)
+
+        # read storage format
+        self._tensor_format = COMPRESSED_TENSOR_FORMAT
+        if 'format' in config.keys():
+            self._tensor_format = config['format']
+        if self._tensor_format not in TENSOR_FORMATS:
+            raise ValueError('Tensor format %s not supported! Must be one of %s' %(self._tensor_format, TENSOR_FORMATS))
+        self._compressed = self._tensor_format == COMPRESSED_TENSOR_FORMAT
+
+        # read the dtype of each field and the dtype it is stored in
+        self._field_dtypes, self._storage_dtypes, self._field_scales, self._field_codecs = parse_field_specs(self._config['fields'])
+        for field_name, codec in self._field_codecs.items():
+            if codec is not None and not self._compressed:
+                raise ValueError('Codec %s requires the %s format' %(codec, COMPRESSED_TENSOR_FORMAT))
 
         # open dataset folder
         # create dataset if necessary
@@ -259,14 +611,14 @@ class TensorDataset(object):
         self._allocate_tensors()
 
         # init tensor cache
+        # _tensor_cache_file_num tracks the file held by the preallocated (writable) tensors,
+        # while tensors loaded for reading are kept in the LRU caches
         self._tensor_cache_file_num = {}
+        self._tensor_caches = {}
         for field_name in self.field_names:
             self._tensor_cache_file_num[field_name] = None
+            self._tensor_caches[field_name] = TensorCache(cache_size)
 
-        # init index maps
-        self._index_to_file_num = {}
-        self._file_num_to_indices = {}
-            
         # init state variables
         if access_mode == WRITE_ACCESS:
             # init no files
@@ -281,10 +633,14 @@ class TensorDataset(object):
             self._metadata = {}
             if os.path.exists(self.metadata_filename):
                 self._metadata = json.load(open(self.metadata_filename, 'r'))
+            self._index = self._load_index()
             
             # read the number of tensor files
             tensor_dir = self.tensor_dir
-            tensor_filenames = filenames(tensor_dir, tag=COMPRESSED_TENSOR_EXT, sorted=True)
+            tensor_ext = TENSOR_EXT
+            if self._compressed:
+                tensor_ext = COMPRESSED_TENSOR_EXT
+            tensor_filenames = filenames(tensor_dir, tag=tensor_ext, sorted=True)
             pruned_tensor_filenames = []
             for filename in tensor_filenames:
                 try:
@@ -295,40 +651,27 @@ class TensorDataset(object):
             tensor_filenames = pruned_tensor_filenames    
             file_nums = np.array([int(filename[-9:-4]) for filename in tensor_filenames])
             if len(file_nums) > 0:
-                self._num_tensors = np.max(file_nums)+1
+                self._num_tensors = int(np.max(file_nums))+1
             else:
                 self._num_tensors = 0
 
-            # compute the number of datapoints
-            self._num_datapoints_last_file = 0
+            # compute the number of datapoints, using the index or the count stored in the
+            # metadata when they are consistent with the tensor files to avoid loading the last file
             self._num_datapoints = 0
-            if file_nums.shape[0] > 0:
-                last_tensor_ind = np.where(file_nums == self._num_tensors-1)[0][0]
-                last_tensor_data = np.load(tensor_filenames[last_tensor_ind])['arr_0']
-                self._num_datapoints_last_file = last_tensor_data.shape[0]
-                self._num_datapoints = self._datapoints_per_file * (self._num_tensors-1) + self._num_datapoints_last_file
-
-            # set file index
-            cur_file_num = 0
-            start_datapoint_index = 0
-
-            # set mapping from file num to datapoint indices
-            self._file_num_to_indices[cur_file_num] = np.arange(self._datapoints_per_file) + start_datapoint_index
-
-            for ind in range(self._num_datapoints):
-                # update to the next file
-                if ind > 0 and ind % self._datapoints_per_file == 0:
-                    cur_file_num += 1
-                    start_datapoint_index += self._datapoints_per_file
-
-                    # set mapping from file num to datapoint indices
-                    if cur_file_num < self._num_tensors-1:
-                        self._file_num_to_indices[cur_file_num] = np.arange(self._datapoints_per_file) + start_datapoint_index
-                    else:
-                        self._file_num_to_indices[cur_file_num] = np.arange(self._num_datapoints_last_file) + start_datapoint_index
-
-                # set mapping from index to file num
-                self._index_to_file_num[ind] = cur_file_num
+            last_entry = None
+            if self._num_tensors > 0:
+                last_filename = self.generate_tensor_filename(self.field_names[0], self._num_tensors-1)
+                last_entry = self._index.get(os.path.basename(last_filename))
+            if last_entry is not None and os.path.exists(last_filename) and \
+               last_entry['bytes'] == os.path.getsize(last_filename):
+                self._num_datapoints = self._datapoints_per_file * (self._num_tensors-1) + last_entry['rows']
+            elif 'num_datapoints' in self._metadata.keys() and \
+               self._num_tensors == -(-self._metadata['num_datapoints'] // self._datapoints_per_file):
+                self._num_datapoints = self._metadata['num_datapoints']
+            elif file_nums.shape[0] > 0:
+                last_tensor = self.load_tensor(self.field_names[0], self._num_tensors-1)
+                self._num_datapoints = self._datapoints_per_file * (self._num_tensors-1) + last_tensor.size
+        self._num_saved_datapoints = self._num_datapoints
 
     @property
     def filename(self):
@@ -345,6 +688,10 @@ class TensorDataset(object):
     @property
     def metadata_filename(self):
         return os.path.join(self._filename, 'metadata.json')
+
+    @property
+    def index_filename(self):
+        return os.path.join(self._filename, 'index.json')
     
     @property
     def num_tensors(self):
@@ -354,6 +701,12 @@ class TensorDataset(object):
     def num_datapoints(self):
         return self._num_datapoints
 
+    @property
+    def num_saved_datapoints(self):
+        """ Returns the number of datapoints whose tensor files have been completely written,
+        which excludes the write buffer and any background write that has not finished. """
+        return self._num_saved_datapoints
+
     @property
     def datapoints_per_file(self):
         return self._datapoints_per_file
@@ -406,16 +759,25 @@ class TensorDataset(object):
         """ Returns the indices for all datapoints in the given tensor. """
         if tensor_index >= self._num_tensors:
             raise ValueError('Tensor index %d is greater than the number of tensors (%d)' %(tensor_index, self._num_tensors))
-        return self._file_num_to_indices[tensor_index]
+        start_index = tensor_index * self._datapoints_per_file
+        end_index = min(start_index + self._datapoints_per_file, self._num_datapoints)
+        return np.arange(start_index, end_index)
 
     def tensor_index(self, datapoint_index):
         """ Returns the index of the tensor containing the referenced datapoint. """
         if datapoint_index >= self._num_datapoints:
             raise ValueError('Datapoint index %d is greater than the number of datapoints (%d)' %(datapoint_index, self._num_datapoints))
-        return self._index_to_file_num[datapoint_index]
+        return datapoint_index // self._datapoints_per_file
 
-    def generate_tensor_filename(self, field_name, file_num, compressed=True):
-        """ Generate a filename for a tensor. """
+    @property
+    def tensor_format(self):
+        """ Returns the on-disk format of the tensors. """
+        return self._tensor_format
+
+    def generate_tensor_filename(self, field_name, file_num, compressed=None):
+        """ Generate a filename for a tensor. Uses the dataset format if compressed is None. """
+        if compressed is None:
+            compressed = self._compressed
         file_ext = TENSOR_EXT
         if compressed:
             file_ext = COMPRESSED_TENSOR_EXT
@@ -448,13 +810,17 @@ class TensorDataset(object):
     
     def _allocate_tensors(self):
         """ Allocates the tensors in the dataset. """
+        self._tensors = self._create_tensors()
+
+    def _create_tensors(self):
+        """ Returns a dict of empty tensors, one per field, holding a file each. """
         # init tensors dict
-        self._tensors = {}
+        tensors = {}
 
         # allocate tensor for each data field
         for field_name, field_spec in self._config['fields'].items():
             # parse attributes
-            field_dtype = np.dtype(field_spec['dtype'])
+            field_dtype = self._storage_dtypes[field_name]
             
             # parse shape
             field_shape = [self._datapoints_per_file]
@@ -466,7 +832,28 @@ class TensorDataset(object):
                         field_shape.append(field_spec['channels'])
                         
             # create tensor
-            self._tensors[field_name] = Tensor(field_shape, field_dtype)
+            tensors[field_name] = Tensor(field_shape, field_dtype)
+        return tensors
+
+    def _encode(self, field_name, value):
+        """ Converts a value of a field to the dtype it is stored in. """
+        storage_dtype = self._storage_dtypes[field_name]
+        if storage_dtype == self._field_dtypes[field_name]:
+            return value
+        value = np.asarray(value, dtype=self._field_dtypes[field_name])
+        if self._field_scales[field_name] is not None:
+            # truncate to fixed point, like Quantize in tools/utils, checking the range
+            # on the scaled values instead of making an int64 copy
+            value = value * self._field_scales[field_name]
+            info = np.iinfo(storage_dtype)
+            if value.size > 0 and not (value.min() > info.min - 1 and value.max() < info.max + 1):
+                raise ValueError('Values of field %s out of range for storage dtype %s with scale %s'
+                                 %(field_name, storage_dtype, self._field_scales[field_name]))
+        return value.astype(storage_dtype)
+
+    def _decode(self, field_name, value):
+        """ Converts a stored value of a field back to the dtype of the field. """
+        return decode_field(value, self._field_dtypes[field_name], self._storage_dtypes[field_name], self._field_scales[field_name])
 
     def add(self, datapoint):
         """ Adds a datapoint to the file. """
@@ -474,46 +861,115 @@ class TensorDataset(object):
         if self._access_mode == READ_ONLY_ACCESS:
             raise ValueError('Cannot add datapoints with read-only access')
 
+        # raise errors from the background writer
+        if self._pending_write is not None and self._pending_write.done():
+            self._wait_for_write()
+
         # read tensor datapoint ind
         tensor_ind = self._num_datapoints // self._datapoints_per_file
         # check datapoint fields
         for field_name in datapoint.keys():
-            if field_name not in self.field_names:
+            if field_name not in self._tensors:
                 raise ValueError('Field %s not specified in dataset' %(field_name))
         
+        # encode every field before adding any, so that a value out of range for its
+        # storage dtype leaves the fields aligned
+        values = {}
+        for field_name in self._tensors.keys():
+            values[field_name] = self._encode(field_name, datapoint[field_name])
+
         # store data in tensor
+        self._prepare_tensors(tensor_ind)
+        for field_name, tensor in self._tensors.items():
+            tensor.add(values[field_name])
+
+        # increment num_datapoints
+        self._num_datapoints += 1
+
+        # save if tensors are full
+        self._write_if_full(tensor_ind)
+
+    def add_batch(self, datapoints):
+        """ Adds a batch of datapoints to the dataset, filling the tensors with
+        one slice assignment per field and tensor file.
+
+        Parameters
+        ----------
+        datapoints : dict
+            mapping from every field name to the stacked values of the batch
+        """
+        # check access level
+        if self._access_mode == READ_ONLY_ACCESS:
+            raise ValueError('Cannot add datapoints with read-only access')
+
+        # raise errors from the background writer
+        if self._pending_write is not None and self._pending_write.done():
+            self._wait_for_write()
+
+        # check datapoint fields
+        for field_name in datapoints.keys():
+            if field_name not in self.field_names:
+                raise ValueError('Field %s not specified in dataset' %(field_name))
+        values = {}
+        for field_name in self.field_names:
+            if field_name not in datapoints.keys():
+                raise ValueError('Field %s missing from batch' %(field_name))
+            values[field_name] = np.asarray(datapoints[field_name])
+            if self._field_scales[field_name] is not None and values[field_name].size > 0:
+                # encoding is monotonic, so encoding the extremes raises for out of range values
+                # before any datapoint is added
+                self._encode(field_name, np.array([values[field_name].min(), values[field_name].max()]))
+        num_datapoints = values[self.field_names[0]].shape[0]
+        for field_name in self.field_names:
+            if values[field_name].shape[0] != num_datapoints:
+                raise ValueError('Field %s has %d datapoints, expected %d' %(field_name, values[field_name].shape[0], num_datapoints))
+
+        # fill the tensors file by file
+        start_index = 0
+        while start_index < num_datapoints:
+            tensor_ind = self._num_datapoints // self._datapoints_per_file
+            self._prepare_tensors(tensor_ind)
+            num_free = self._datapoints_per_file - self._tensors[self.field_names[0]].size
+            end_index = min(start_index + num_free, num_datapoints)
+            for field_name in self.field_names:
+                # encode one file at a time to bound the memory of the encoded copies
+                self._tensors[field_name].add_batch(self._encode(field_name, values[field_name][start_index:end_index]))
+            self._num_datapoints += end_index - start_index
+            start_index = end_index
+            self._write_if_full(tensor_ind)
+
+    def _prepare_tensors(self, tensor_ind):
+        """ Points the preallocated tensors at the given file, loading it if it exists. """
+        if tensor_ind == self._tensor_cache_file_num[self.field_names[0]]:
+            # the preallocated tensors already hold the file
+            return
         cur_num_tensors = self._num_tensors
         new_num_tensors = cur_num_tensors
         for field_name in self.field_names:
             if tensor_ind < cur_num_tensors:
                 # load tensor if it was previously allocated
-                self._tensors[field_name] = self.tensor(field_name, tensor_ind)
+                self._load_tensor_for_writing(field_name, tensor_ind)
             else:
                 # clear tensor if this is a new tensor
                 self._tensors[field_name].reset()
                 self._tensor_cache_file_num[field_name] = tensor_ind
                 new_num_tensors = cur_num_tensors + 1
                 self._has_unsaved_data = True
-            self._tensors[field_name].add(datapoint[field_name])
-            cur_size = self._tensors[field_name].size
 
         # update num tensors
         if new_num_tensors > cur_num_tensors:
             self._num_tensors = new_num_tensors
 
-        # update file indices
-        self._index_to_file_num[self._num_datapoints] = tensor_ind
-        self._file_num_to_indices[tensor_ind] = tensor_ind * self._datapoints_per_file + np.arange(cur_size)
-
-        # save if tensors are full
+    def _write_if_full(self, tensor_ind):
+        """ Saves the preallocated tensors to file once they are full. """
         field_name = self.field_names[0]
         if self._tensors[field_name].is_full:
             # save next tensors to file
             logging.info('Dataset %s: Writing tensor %d to disk' %(self.filename, tensor_ind))
-            self.write()
-
-        # increment num_datapoints
-        self._num_datapoints += 1
+            if self._async_write:
+                self._write_async()
+            else:
+                self.write()
 
     def __getitem__(self, inds):
         if isinstance(inds, slice):
@@ -521,17 +977,71 @@ class TensorDataset(object):
         else:
             return self.datapoint(inds)
 
-    def get_item_list(self, indices):
-        rbt_to_euler = lambda rbt: transformations.euler_from_quaternion(transformations.quaternion_from_matrix(rbt))
-        return {
+    def get_item_list(self, indices, field_names=None):
+        """ Loads a training batch for the given global indices.
+        Depth images are returned as contiguous batch_size x 1 x height x width
+        float32 arrays, ready to be wrapped with torch.from_numpy.
+
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            global indices of the datapoints in the batch
+        field_names : :obj:`list` of str
+            field names to load (None for all the fields used in training)
+
+        Returns
+        -------
+        dict
+            mapping from field name to the stacked values for the batch
+        """
+        if field_names is None:
+            field_names = ITEM_LIST_FIELD_NAMES
+        return TensorDataset.to_item_list(self.datapoints(indices, field_names=field_names))
+
+    @staticmethod
+    def to_item_list(batch):
+        """ Converts a batch returned by datapoints to the layout returned by get_item_list. """
+        for field_name in set(batch.keys()) & set(["depth_image1", "depth_image2"]):
             # should be batch_size x n_channels x 128 x 128 (n_channels should be 1 for depth images)
-            "depth_image1" : np.expand_dims(np.array([self.datapoint(i)["depth_image1"][:, :, -1] for i in indices]), axis=1), 
-            "depth_image2" : np.expand_dims(np.array([self.datapoint(i)["depth_image2"][:, :, -1] for i in indices]), axis=1), 
-            "quaternion"   : np.array([self.datapoint(i)["quaternion"] for i in indices]),
-            "lie"          : np.array([self.datapoint(i)["lie"] for i in indices]),
-            "pose_matrix"  : np.array([self.datapoint(i)["pose_matrix"] for i in indices]),
-            "obj_id"       : np.array([self.datapoint(i)["obj_id"] for i in indices])
-        }
+            images = np.expand_dims(batch[field_name][..., -1], axis=1)
+            batch[field_name] = np.ascontiguousarray(images, dtype=np.float32)
+        return batch
+
+    def datapoints(self, indices, field_names=None):
+        """ Loads a batch of datapoints for the given global indices.
+        Indices are grouped by tensor file so that each field is gathered
+        with a single indexing operation per file.
+
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            global indices in the dataset, in the order they should be returned
+        field_names : :obj:`list` of str
+            field names to load
+
+        Returns
+        -------
+        dict
+            mapping from field name to an array of stacked datapoints
+        """
+        # flush if necessary
+        if self._has_unsaved_data or self._pending_write is not None:
+            self.flush()
+
+        # check valid input
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        if indices.shape[0] > 0 and (indices.max() >= self._num_datapoints or indices.min() < 0):
+            raise ValueError('Indices must be in the range [0, %d)' %(self._num_datapoints))
+
+        # load the field names
+        if field_names is None:
+            field_names = self.field_names
+
+        # gather each field once per file
+        field_shapes = dict([(field_name, self._tensors[field_name].shape[1:]) for field_name in field_names])
+        def read_values(field_name, file_num, tensor_indices):
+            return self._decode(field_name, self.tensor(field_name, file_num).data_slice(tensor_indices))
+        return gather_datapoints(indices, self._datapoints_per_file, field_names, field_shapes, self._field_dtypes, read_values)
 
     def datapoint(self, ind, field_names=None):
         """ Loads a tensor datapoint for a given global index.
@@ -549,7 +1059,7 @@ class TensorDataset(object):
             the desired tensor datapoint
         """
         # flush if necessary
-        if self._has_unsaved_data:
+        if self._has_unsaved_data or self._pending_write is not None:
             self.flush()
 
         # check valid input
@@ -562,13 +1072,51 @@ class TensorDataset(object):
         
         # return the datapoint
         datapoint = TensorDatapoint(field_names)
-        file_num = self._index_to_file_num[ind]
+        file_num = ind // self._datapoints_per_file
         for field_name in field_names:
             tensor = self.tensor(field_name, file_num)
             tensor_index = ind % self._datapoints_per_file
-            datapoint[field_name] = tensor.datapoint(tensor_index)
+            datapoint[field_name] = self._decode(field_name, tensor.datapoint(tensor_index))
         return datapoint
 
+    def view(self, indices=None, field_names=None, transforms=None):
+        """ Returns a read-only view of a subset of the datapoints and fields, without copying data.
+
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            global indices of the datapoints in the view, in order (None for all datapoints)
+        field_names : :obj:`list` of str
+            fields in the view (None for all fields)
+        transforms : dict
+            mapping from field name to a function applied to each batch of the field when it is read
+
+        Returns
+        -------
+        :obj:`TensorDatasetView`
+            the view
+        """
+        from .dataset_view import TensorDatasetView
+        return TensorDatasetView(self, indices=indices, field_names=field_names, transforms=transforms)
+
+    def column(self, field_name):
+        """ Loads the values of a single field for every datapoint,
+        without reading the files of any other field.
+
+        Parameters
+        ----------
+        field_name : str
+            the name of the field to load
+
+        Returns
+        -------
+        :obj:`numpy.ndarray`
+            the stacked values of the field, indexed by global datapoint index
+        """
+        if field_name not in self.field_names:
+            raise ValueError('Field %s not specified in dataset' %(field_name))
+        return self.datapoints(self.datapoint_indices, field_names=[field_name])[field_name]
+
     def tensor(self, field_name, tensor_ind):
         """ Returns the tensor for a given field and tensor index.
 
@@ -586,12 +1134,269 @@ class TensorDataset(object):
         """
         if tensor_ind == self._tensor_cache_file_num[field_name]:
             return self._tensors[field_name]
-        filename = self.generate_tensor_filename(field_name, tensor_ind, compressed=True)
-        Tensor.load(filename, compressed=True,
-                    prealloc=self._tensors[field_name])
+        tensor = self._tensor_caches[field_name].get(tensor_ind)
+        if tensor is None:
+            tensor = self.load_tensor(field_name, tensor_ind)
+            self._tensor_caches[field_name].put(tensor_ind, tensor)
+        return tensor
+
+    def load_tensor(self, field_name, tensor_ind):
+        """ Reads the tensor for a given field and tensor index from disk, bypassing the cache.
+        Does not modify the dataset, so it can be called from background threads.
+        """
+        filename = self.generate_tensor_filename(field_name, tensor_ind)
+        if self._local_dataset_dir is not None:
+            filename = self._local_tensor_filename(filename)
+        if self._field_codecs[field_name] == BBOX_CODEC:
+            return BBoxImageTensor.load(filename)
+        return Tensor.load(filename, compressed=self._compressed, mmap=True)
+
+    @property
+    def local_cache_dir(self):
+        """ Returns the local directory the tensor files are staged to, or None. """
+        return self._local_cache_dir
+
+    @property
+    def local_dataset_dir(self):
+        """ Returns the directory of the local copy of this dataset, under the local cache directory. """
+        return self._local_dataset_dir
+
+    def _local_tensor_filename(self, filename):
+        """ Returns the filename of the local copy of a tensor file if it is valid, and otherwise
+        returns the source filename and starts copying the file in the background.
+        """
+        local_filename = os.path.join(self._local_dataset_dir, os.path.relpath(filename, self._filename))
+        with self._local_lock:
+            if filename in self._local_files:
+                return local_filename
+            if filename in self._local_copies:
+                return filename
+
+        # check a copy left by an earlier process against the source
+        if os.path.exists(local_filename):
+            source_stat = os.stat(filename)
+            local_stat = os.stat(local_filename)
+            if local_stat.st_size == source_stat.st_size and local_stat.st_mtime == source_stat.st_mtime:
+                with self._local_lock:
+                    self._local_files.add(filename)
+                return local_filename
+
+        with self._local_lock:
+            if filename not in self._local_copies:
+                self._local_copies[filename] = self._local_copier.submit(self._copy_to_local, filename, local_filename)
+        return filename
+
+    def _copy_to_local(self, filename, local_filename):
+        """ Copies a tensor file to the local cache, keeping its modification time. """
+        temp_filename = '%s.%d.tmp' %(local_filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(local_filename), exist_ok=True)
+            shutil.copy2(filename, temp_filename)
+            os.replace(temp_filename, local_filename)
+            with self._local_lock:
+                self._local_files.add(filename)
+        except (IOError, OSError) as e:
+            logging.warning('Dataset %s: Could not copy %s to the local cache: %s' %(self.filename, filename, e))
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+        finally:
+            with self._local_lock:
+                self._local_copies.pop(filename, None)
+
+    def save_tensor(self, field_name, tensor_ind, tensor):
+        """ Writes a tensor (dense or encoded) for a given field and tensor index to disk,
+        encoding it with the codec of the field. Returns False if the tensor is empty.
+        """
+        if tensor.size == 0:
+            return False
+        filename = self.generate_tensor_filename(field_name, tensor_ind)
+        if self._field_codecs[field_name] == BBOX_CODEC:
+            if not isinstance(tensor, BBoxImageTensor):
+                tensor = BBoxImageTensor.encode(tensor.arr)
+        elif isinstance(tensor, BBoxImageTensor):
+            tensor = tensor.dense()
+
+        # write to a temporary file first, so that the file is never partially written
+        # and readers that memory-mapped the previous file keep their data
+        _, file_ext = os.path.splitext(filename)
+        temp_filename = filename + '.tmp' + file_ext
+        saved = tensor.save(temp_filename, compressed=self._compressed)
+        if saved:
+            os.replace(temp_filename, filename)
+            self._index_tensor(field_name, filename, tensor)
+        return saved
+
+    def _index_tensor(self, field_name, filename, tensor):
+        """ Records the size, checksum and value statistics of a saved tensor in the index. """
+        if isinstance(tensor, BBoxImageTensor):
+            values = tensor.data_slice(np.arange(tensor.size))
+        else:
+            values = tensor.arr
+        values = self._decode(field_name, values)
+        entry = {
+            'field_name': field_name,
+            'rows': int(tensor.size),
+            'bytes': os.path.getsize(filename),
+            'crc32': file_checksum(filename),
+            'min': float(np.min(values)),
+            'max': float(np.max(values)),
+            'mean': float(np.mean(values, dtype=np.float64))
+        }
+        with self._metadata_lock:
+            self._index[os.path.basename(filename)] = entry
+
+    def _unindex_tensor(self, filename):
+        """ Removes a tensor file from the index. """
+        with self._metadata_lock:
+            self._index.pop(os.path.basename(filename), None)
+
+    def _load_index(self):
+        """ Reads the index of the tensor files, or returns an empty index if there is none. """
+        if not os.path.exists(self.index_filename):
+            return {}
+        try:
+            index = json.load(open(self.index_filename, 'r'))
+        except ValueError:
+            logging.warning('Dataset %s: Could not read the index' %(self.filename))
+            return {}
+        if index.get('version') != INDEX_VERSION:
+            return {}
+        return index['files']
+
+    def _save_index(self):
+        """ Writes the index of the tensor files, replacing the previous index atomically. """
+        with self._metadata_lock:
+            index = {
+                'version': INDEX_VERSION,
+                'datapoints_per_file': self._datapoints_per_file,
+                'num_datapoints': self._num_datapoints,
+                'files': self._index
+            }
+            write_json_atomic(index, self.index_filename)
+
+    def reindex(self):
+        """ Rebuilds the index from the tensor files on disk, e.g. for datasets written before indexing. """
+        if self._access_mode == READ_ONLY_ACCESS:
+            raise ValueError('Cannot index a dataset with read-only access')
+        with self._metadata_lock:
+            self._index = {}
+        for tensor_ind in range(self._num_tensors):
+            for field_name in self.field_names:
+                filename = self.generate_tensor_filename(field_name, tensor_ind)
+                self._index_tensor(field_name, filename, self.load_tensor(field_name, tensor_ind))
+        self._save_index()
+
+    def verify(self, num_workers=8, deep=False):
+        """ Checks the tensor files against the index.
+
+        Parameters
+        ----------
+        num_workers : int
+            number of threads reading and checksumming files
+        deep : bool
+            whether to also load every tensor and check its number of rows and statistics
+
+        Returns
+        -------
+        :obj:`list` of str
+            a description of each problem found, empty if the dataset is intact
+        """
+        if self._has_unsaved_data or self._pending_write is not None:
+            self.flush()
+        if len(self._index) == 0 and self._num_tensors > 0:
+            return ['Dataset %s has no index' %(self.filename)]
+
+        # check that the index covers exactly the expected files and rows
+        problems = []
+        expected_filenames = []
+        for tensor_ind in range(self._num_tensors):
+            num_rows = len(self.datapoint_indices_for_tensor(tensor_ind))
+            for field_name in self.field_names:
+                filename = self.generate_tensor_filename(field_name, tensor_ind)
+                expected_filenames.append((field_name, tensor_ind, filename))
+                entry = self._index.get(os.path.basename(filename))
+                if entry is None:
+                    problems.append('%s is not in the index' %(filename))
+                elif entry['rows'] != num_rows:
+                    problems.append('%s has %d rows in the index, expected %d' %(filename, entry['rows'], num_rows))
+        expected_basenames = set([os.path.basename(filename) for _, _, filename in expected_filenames])
+        for basename in sorted(set(self._index.keys()) - expected_basenames):
+            problems.append('%s is in the index but not part of the dataset' %(basename))
+
+        def check_file(field_name, tensor_ind, filename):
+            entry = self._index.get(os.path.basename(filename))
+            if entry is None:
+                return []
+            if not os.path.exists(filename):
+                return ['%s is missing' %(filename)]
+            if os.path.getsize(filename) != entry['bytes']:
+                return ['%s has %d bytes, expected %d' %(filename, os.path.getsize(filename), entry['bytes'])]
+            if file_checksum(filename) != entry['crc32']:
+                return ['%s has the wrong checksum' %(filename)]
+            if deep:
+                tensor = self.load_tensor(field_name, tensor_ind)
+                if isinstance(tensor, BBoxImageTensor):
+                    values = tensor.data_slice(np.arange(tensor.size))
+                else:
+                    values = tensor.arr
+                values = self._decode(field_name, values)
+                stats = [np.min(values), np.max(values), np.mean(values, dtype=np.float64)]
+                if tensor.size != entry['rows'] or \
+                   not np.allclose(stats, [entry['min'], entry['max'], entry['mean']]):
+                    return ['%s does not match its index statistics' %(filename)]
+            return []
+
+        # check the contents of the files in parallel
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(check_file, field_name, tensor_ind, filename)
+                       for field_name, tensor_ind, filename in expected_filenames]
+            for future in futures:
+                try:
+                    problems.extend(future.result())
+                except Exception as e:
+                    problems.append(str(e))
+        return problems
+
+    def is_cached(self, field_name, tensor_ind):
+        """ Returns true if the tensor for a given field and tensor index is loaded in memory. """
+        return tensor_ind == self._tensor_cache_file_num[field_name] or \
+            tensor_ind in self._tensor_caches[field_name]
+
+    def cache_tensor(self, field_name, tensor_ind, tensor):
+        """ Adds a tensor read with load_tensor to the cache of its field. """
+        self._tensor_caches[field_name].put(tensor_ind, tensor)
+
+    def _load_tensor_for_writing(self, field_name, tensor_ind):
+        """ Loads a tensor from disk into the preallocated tensor for the field,
+        so that datapoints can be appended to it or removed from it. """
+        if tensor_ind == self._tensor_cache_file_num[field_name]:
+            return self._tensors[field_name]
+        self._wait_for_write()
+        filename = self.generate_tensor_filename(field_name, tensor_ind)
+        if self._field_codecs[field_name] == BBOX_CODEC:
+            BBoxImageTensor.load(filename).dense(prealloc=self._tensors[field_name])
+        else:
+            Tensor.load(filename, compressed=self._compressed,
+                        prealloc=self._tensors[field_name])
         self._tensor_cache_file_num[field_name] = tensor_ind
+        self._tensor_caches[field_name].remove(tensor_ind)
         return self._tensors[field_name]
 
+    @property
+    def cache_size(self):
+        """ Returns the maximum number of bytes cached per field. """
+        return self._cache_size
+
+    @property
+    def cache_stats(self):
+        """ Returns the hit, miss and eviction counters of the tensor cache for each field. """
+        return dict([(field_name, cache.stats) for field_name, cache in self._tensor_caches.items()])
+
+    def clear_cache(self):
+        """ Empties the tensor cache of every field. """
+        for cache in self._tensor_caches.values():
+            cache.clear()
+
     def __iter__(self):
         """ Generate iterator. Not thread safe. """
         self._count = 0
@@ -625,60 +1430,75 @@ class TensorDataset(object):
         num_to_delete : int
             the number of datapoints to remove from the end of the dataset
         """
-        # check access level
-        if self._access_mode == READ_ONLY_ACCESS:
-            raise ValueError('Cannot delete datapoints with read-only access')
-
-        # check num to delete
         if num_to_delete > self._num_datapoints:
             raise ValueError('Cannot remove more than the number of datapoints in the dataset')
+        self.truncate(self._num_datapoints - num_to_delete)
 
-        # compute indices
-        last_datapoint_ind = self._num_datapoints - 1
-        last_tensor_ind = last_datapoint_ind // self._datapoints_per_file
-        new_last_datapoint_ind = self._num_datapoints - 1 - num_to_delete
-        new_num_datapoints = new_last_datapoint_ind + 1
+    def truncate(self, num_datapoints):
+        """ Removes all datapoints after the first num_datapoints from the dataset.
+        Tensor files past the new end are deleted, starting from the last one, and only the
+        new last file of each field is rewritten if it keeps some of its datapoints, so an
+        interrupted truncation leaves a readable dataset. The metadata and index are then
+        replaced atomically.
+
+        Parameters
+        ----------
+        num_datapoints : int
+            the number of datapoints to keep
+        """
+        # check access level
+        if self._access_mode == READ_ONLY_ACCESS:
+            raise ValueError('Cannot delete datapoints with read-only access')
+        if num_datapoints < 0 or num_datapoints > self._num_datapoints:
+            raise ValueError('Cannot truncate a dataset with %d datapoints to %d datapoints'
+                             %(self._num_datapoints, num_datapoints))
+        self._wait_for_write()
 
-        new_last_datapoint_ind = max(new_last_datapoint_ind, 0)
-        new_last_tensor_ind = new_last_datapoint_ind // self._datapoints_per_file
+        new_num_tensors = -(-num_datapoints // self._datapoints_per_file)
+        last_tensor_size = num_datapoints - (new_num_tensors - 1) * self._datapoints_per_file
 
-        # delete all but the last tensor
-        delete_tensor_ind = range(new_last_tensor_ind+1, last_tensor_ind+1) 
-        for tensor_ind in delete_tensor_ind:
+        # delete the files past the new end, including files that only exist in the write buffer
+        for tensor_ind in range(self._num_tensors - 1, new_num_tensors - 1, -1):
             for field_name in self.field_names:
                 filename = self.generate_tensor_filename(field_name, tensor_ind)
-                os.remove(filename)
-
-        # update last tensor
-        dataset_empty = False
-        target_tensor_size = new_num_datapoints % self._datapoints_per_file
-        if target_tensor_size == 0:
-            if new_num_datapoints > 0:
-                target_tensor_size = self._datapoints_per_file
-            else:
-                dataset_empty = True
+                if os.path.exists(filename):
+                    os.remove(filename)
+                self._unindex_tensor(filename)
+                self._tensor_caches[field_name].remove(tensor_ind)
+                if self._tensor_cache_file_num[field_name] == tensor_ind:
+                    self._tensors[field_name].reset()
+                    self._tensor_cache_file_num[field_name] = None
+                    self._has_unsaved_data = False
+
+        # drop the datapoints past the new end from the new last file
+        if new_num_tensors > 0:
+            tensor_ind = new_num_tensors - 1
+            for field_name in self.field_names:
+                if self._tensor_cache_file_num[field_name] == tensor_ind:
+                    tensor = self._tensors[field_name]
+                    if tensor.size > last_tensor_size:
+                        tensor.cur_index = last_tensor_size
+                        self.save_tensor(field_name, tensor_ind, tensor)
+                        self._has_unsaved_data = False
+                    continue
 
-        for field_name in self.field_names:
-            new_last_tensor = self.tensor(field_name, new_last_tensor_ind)
-            while new_last_tensor.size > target_tensor_size:
-                new_last_tensor.delete_last()
-            filename = self.generate_tensor_filename(field_name, new_last_tensor_ind)
-            new_last_tensor.save(filename, compressed=True)
-            if not new_last_tensor.has_data:
-                os.remove(filename)
-                new_last_tensor.reset()
-        
-        # update num datapoints            
-        if self._num_datapoints - 1 - num_to_delete >= 0:
-            self._num_datapoints = new_num_datapoints
-        else:
-            self._num_datapoints = 0
+                filename = self.generate_tensor_filename(field_name, tensor_ind)
+                entry = self._index.get(os.path.basename(filename))
+                if entry is not None and entry['rows'] == last_tensor_size:
+                    continue
+                tensor = self.load_tensor(field_name, tensor_ind)
+                if tensor.size > last_tensor_size:
+                    values = tensor.data_slice(np.arange(last_tensor_size))
+                    self.save_tensor(field_name, tensor_ind, Tensor(values.shape, values.dtype, data=values))
+                    self._tensor_caches[field_name].remove(tensor_ind)
+
+        # write the new number of datapoints and the index to file
+        self._num_datapoints = num_datapoints
+        self._num_saved_datapoints = min(self._num_saved_datapoints, num_datapoints)
+        self._num_tensors = new_num_tensors
+        self._save_metadata()
+        self._save_index()
 
-        # handle deleted tensor
-        self._num_tensors = new_last_tensor_ind + 1
-        if dataset_empty:
-            self._num_tensors = 0
-            
     def add_metadata(self, key, value):
         """ Adds metadata (key-value pairs) to the dataset.
 
@@ -689,35 +1509,81 @@ class TensorDataset(object):
         value : :obj:`object` must be JSON serializable
             content of metadata
         """
-        self._metadata[key] = value
+        with self._metadata_lock:
+            self._metadata[key] = value
 
         # write the current metadata to file
-        json.dump(self._metadata, open(self.metadata_filename, 'w'),
-                  indent=JSON_INDENT,
-                  sort_keys=True)
+        self._save_metadata()
+
+    def _save_metadata(self, num_datapoints=None):
+        """ Writes the metadata, including the number of datapoints (the current number if None), to file. """
+        if num_datapoints is None:
+            num_datapoints = self._num_datapoints
+        with self._metadata_lock:
+            self._metadata['num_datapoints'] = num_datapoints
+            write_json_atomic(self._metadata, self.metadata_filename)
     
     def write(self):
         """ Writes all tensors to the next file number. """
         # write the next file for all fields
         for field_name in self.field_names:
-            filename = self.generate_tensor_filename(field_name, self._num_tensors-1)
-            self._tensors[field_name].save(filename, compressed=True)
+            self.save_tensor(field_name, self._num_tensors-1, self._tensors[field_name])
+            self._tensor_caches[field_name].remove(self._num_tensors-1)
 
         # write the current metadata to file
-        json.dump(self._metadata, open(self.metadata_filename, 'w'),
-                  indent=JSON_INDENT,
-                  sort_keys=True)
+        self._save_metadata()
 
         # update
         self._has_unsaved_data = False
+        self._num_saved_datapoints = self._num_datapoints
         
+    def _write_async(self):
+        """ Hands the full tensors to the background writer and continues with the spare tensors. """
+        # the spare tensors are free once the previous write has finished
+        self._wait_for_write()
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1)
+        if self._spare_tensors is None:
+            self._spare_tensors = self._create_tensors()
+
+        full_tensors = self._tensors
+        self._tensors = self._spare_tensors
+        self._spare_tensors = full_tensors
+        file_num = self._num_tensors - 1
+        for field_name in self.field_names:
+            self._tensors[field_name].reset()
+            self._tensor_cache_file_num[field_name] = None
+            self._tensor_caches[field_name].remove(file_num)
+        self._pending_write = self._writer.submit(self._write_tensors, full_tensors,
+                                                  file_num, self._num_datapoints)
+        self._has_unsaved_data = False
+
+    def _write_tensors(self, tensors, file_num, num_datapoints):
+        """ Saves the given tensors to a file number, run by the background writer. """
+        for field_name, tensor in tensors.items():
+            self.save_tensor(field_name, file_num, tensor)
+        self._save_metadata(num_datapoints)
+        # keep the index on disk up to date for datasets that are only flushed at the end
+        self._save_index()
+        self._num_saved_datapoints = num_datapoints
+
+    def _wait_for_write(self):
+        """ Waits for the background writer, raising any error it encountered. """
+        if self._pending_write is not None:
+            pending_write = self._pending_write
+            self._pending_write = None
+            pending_write.result()
+
     def flush(self):
-        """ Flushes the data tensors and saves metadata to disk. """
+        """ Flushes the data tensors and saves metadata and the index to disk, waiting for background writes. """
+        self._wait_for_write()
         self.write()
+        self._save_index()
 
     @staticmethod
-    def open(dataset_dir, access_mode=READ_ONLY_ACCESS):
-        """ Opens a tensor dataset. """
+    def open(dataset_dir, access_mode=READ_ONLY_ACCESS, cache_size=DEFAULT_CACHE_SIZE, async_write=False,
+             local_cache_dir=None, num_local_copy_workers=4):
+        """ Opens a tensor dataset, optionally staging its tensor files to local_cache_dir on first read. """
         # check access mode
         if access_mode == WRITE_ACCESS:
             raise ValueError('Cannot open a dataset with write-only access')
@@ -733,9 +1599,131 @@ class TensorDataset(object):
             config = YamlConfig(config_filename)
 
         # open dataset
-        dataset = TensorDataset(dataset_dir, config, access_mode=access_mode)
+        dataset = TensorDataset(dataset_dir, config, access_mode=access_mode,
+                                cache_size=cache_size, async_write=async_write,
+                                local_cache_dir=local_cache_dir, num_local_copy_workers=num_local_copy_workers)
         return dataset
 
+    @staticmethod
+    def convert(dataset_dir, output_dir, tensor_format=RAW_TENSOR_FORMAT):
+        """ Copies a tensor dataset into a new dataset stored in another format,
+        e.g. to turn a compressed dataset into memory-mappable raw tensors.
+        Metadata and splits are copied along with the tensors.
+
+        Parameters
+        ----------
+        dataset_dir : str
+            path to the dataset to convert
+        output_dir : str
+            path to the converted dataset, which must not exist yet
+        tensor_format : str
+            on-disk format of the converted tensors ('npz' or 'npy')
+
+        Returns
+        -------
+        :obj:`TensorDataset`
+            the converted dataset, opened read-only
+        """
+        if tensor_format not in TENSOR_FORMATS:
+            raise ValueError('Tensor format %s not supported! Must be one of %s' %(tensor_format, TENSOR_FORMATS))
+        if os.path.exists(output_dir):
+            raise ValueError('Dataset %s already exists!' %(output_dir))
+        dataset = TensorDataset.open(dataset_dir)
+
+        # write the config with the new format
+        config = copy.deepcopy(dict([(key, dataset.config[key]) for key in dataset.config.keys()]))
+        config['format'] = tensor_format
+        if tensor_format == RAW_TENSOR_FORMAT:
+            # codecs need the compressed format, so store every field densely
+            config['fields'] = dense_field_specs(config['fields'])
+        output_dataset = TensorDataset(output_dir, config, access_mode=WRITE_ACCESS)
+
+        # convert the tensors file by file
+        for tensor_ind in range(dataset.num_tensors):
+            for field_name in dataset.field_names:
+                tensor = dataset.load_tensor(field_name, tensor_ind)
+                output_dataset.save_tensor(field_name, tensor_ind, tensor)
+        output_dataset._save_index()
+
+        # copy metadata and splits
+        if os.path.exists(dataset.metadata_filename):
+            shutil.copyfile(dataset.metadata_filename, output_dataset.metadata_filename)
+        if os.path.exists(dataset.split_dir):
+            for split_name in dataset.split_names:
+                shutil.copytree(os.path.join(dataset.split_dir, split_name),
+                                os.path.join(output_dataset.split_dir, split_name))
+        return TensorDataset.open(output_dir)
+
+    @staticmethod
+    def merge(shard_dirs, output_dir, delete_shards=False):
+        """ Merges datasets written in parallel (shards) with the same config into a single dataset.
+        Full tensor files are hard-linked (or copied across filesystems) under their new file
+        numbers without being rewritten, so merging takes time in the number of files.
+        The partially filled last files of the shards are rewritten at the end of the
+        merged dataset, so their datapoints come after those of all full files.
+        Splits are not merged since their indices refer to the shards.
+
+        Parameters
+        ----------
+        shard_dirs : :obj:`list` of str
+            paths to the shards, in the order they should be merged
+        output_dir : str
+            path to the merged dataset, which must not exist yet
+        delete_shards : bool
+            whether to remove the shards after merging
+
+        Returns
+        -------
+        :obj:`TensorDataset`
+            the merged dataset, opened read-only
+        """
+        if len(shard_dirs) == 0:
+            raise ValueError('Must specify at least one shard to merge')
+        if os.path.exists(output_dir):
+            raise ValueError('Dataset %s already exists!' %(output_dir))
+        shards = [TensorDataset.open(shard_dir) for shard_dir in shard_dirs]
+        config = shards[0].config
+        for shard_dir, shard in zip(shard_dirs, shards):
+            if json.dumps(shard.config, sort_keys=True) != json.dumps(config, sort_keys=True):
+                raise ValueError('Shard %s has a different config than shard %s' %(shard_dir, shard_dirs[0]))
+        output_dataset = TensorDataset(output_dir, config, access_mode=WRITE_ACCESS)
+
+        # link the full tensors of each shard under the next file numbers
+        datapoints_per_file = output_dataset.datapoints_per_file
+        num_tensors = 0
+        for shard in shards:
+            num_full_tensors = shard.num_datapoints // datapoints_per_file
+            for tensor_ind in range(num_full_tensors):
+                for field_name in shard.field_names:
+                    filename = shard.generate_tensor_filename(field_name, tensor_ind)
+                    output_filename = output_dataset.generate_tensor_filename(field_name, num_tensors)
+                    try:
+                        os.link(filename, output_filename)
+                    except OSError:
+                        shutil.copyfile(filename, output_filename)
+                    entry = shard._index.get(os.path.basename(filename))
+                    if entry is not None:
+                        output_dataset._index[os.path.basename(output_filename)] = dict(entry)
+                num_tensors += 1
+        output_dataset._num_tensors = num_tensors
+        output_dataset._num_datapoints = num_tensors * datapoints_per_file
+
+        # append the datapoints of the partial tensors
+        for shard in shards:
+            start_index = (shard.num_datapoints // datapoints_per_file) * datapoints_per_file
+            if start_index < shard.num_datapoints:
+                output_dataset.add_batch(shard.datapoints(np.arange(start_index, shard.num_datapoints)))
+
+        # save the metadata of the first shard with the merged number of datapoints
+        output_dataset._metadata = dict(shards[0].metadata)
+        output_dataset._metadata['num_shards'] = len(shards)
+        output_dataset.flush()
+
+        if delete_shards:
+            for shard_dir in shard_dirs:
+                shutil.rmtree(shard_dir)
+        return TensorDataset.open(output_dir)
+
     def split(self, split_name):
         """ Return the training and validation indices for the requested split.
 
@@ -764,7 +1752,7 @@ class TensorDataset(object):
         val_indices = np.load(val_filename)['arr_0']
         return train_indices, val_indices, metadata
         
-    def make_split(self, split_name, val_indices=None, train_pct=0.8, field_name=None):
+    def make_split(self, split_name, val_indices=None, train_pct=0.8, field_name=None, val_values=None):
         """ Splits the dataset into train and test according
         to the given attribute.
         The split is saved with the dataset for future access.
@@ -779,6 +1767,9 @@ class TensorDataset(object):
             percent of data to use for training
         field_name : str
             name of the field to use in splitting (None for raw indices)
+        val_values : :obj:`list`
+            values of field_name whose datapoints are held out for validation, e.g. object ids
+            (overrides train_pct if not None)
 
         Returns
         -------
@@ -799,6 +1790,17 @@ class TensorDataset(object):
         if val_indices is not None:
             all_indices = np.arange(self.num_datapoints)
             train_indices = np.setdiff1d(all_indices, val_indices)
+        elif val_values is not None:
+            # hold out the datapoints with the given values
+            if field_name is None:
+                raise ValueError('Must specify the field of the held-out values')
+            if field_name not in self.config['fields'].keys():
+                raise ValueError('Field %s not in dataset!' %(field_name))
+            if 'height' in self.config['fields'][field_name].keys():
+                raise ValueError('Can only split on scalar fields!')
+            is_val = np.isin(self.column(field_name), val_values)
+            train_indices = np.where(~is_val)[0]
+            val_indices = np.where(is_val)[0]
         elif field_name is None:
             # split on indices
             indices = np.arange(self.num_datapoints)
@@ -809,31 +1811,20 @@ class TensorDataset(object):
             field_name = 'index'
         elif field_name == 'split':
             # split on binary values
-            train_indices = []
-            val_indices = []
-            for i in range(self.num_datapoints):
-                datapoint = self.datapoint(i, field_names=['split'])
-                split = datapoint['split']
-                if split == TRAIN_ID:
-                    train_indices.append(i)
-                else:
-                    val_indices.append(i)
-            train_indices = np.array(train_indices)
-            val_indices = np.array(val_indices)
+            splits = self.column('split')
+            train_indices = np.where(splits == TRAIN_ID)[0]
+            val_indices = np.where(splits != TRAIN_ID)[0]
         else:
             # split on field name
 
             # check valid field
             if field_name not in self.config['fields'].keys():
-                raise ValueError('Field %d not in dataset!' %(field_name))
+                raise ValueError('Field %s not in dataset!' %(field_name))
             if 'height' in self.config['fields'][field_name].keys():
                 raise ValueError('Can only split on scalar fields!')
 
             # find unique values
-            values = []
-            for i in range(self.num_datapoints):
-                datapoint = self.datapoint(i, field_names=[field_name])
-                values.append(datapoint[field_name])
+            values = self.column(field_name)
             unique_values = np.unique(values)
             num_unique = unique_values.shape[0]
             num_train = int(train_pct * num_unique)
@@ -844,16 +1835,9 @@ class TensorDataset(object):
             val_values = unique_values[num_train:]
 
             # aggregate indices
-            train_indices = []
-            val_indices = []
-            for i in range(self.num_datatpoints):
-                datapoint = self.datapoint(i, field_names=[field_name])
-                if datapoint[field_name] in train_values:
-                    train_indices.append(i)
-                else:
-                    val_indices.append(i)
-            train_indices = np.array(train_indices)
-            val_indices = np.array(val_indices)                    
+            is_train = np.isin(values, train_values)
+            train_indices = np.where(is_train)[0]
+            val_indices = np.where(~is_train)[0]
                 
         # sort indices
         train_indices.sort()
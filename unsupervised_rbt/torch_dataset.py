@@ -0,0 +1,178 @@
+"""
+Adapters for reading a TensorDataset through torch.utils.data.DataLoader.
+
+Example usage:
+    dataset = TorchTensorDataset(dataset_dir)
+    sampler = ChunkBatchSampler(train_indices, dataset.datapoints_per_file, batch_size=64, num_workers=4)
+    loader = DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=4,
+                        pin_memory=True, persistent_workers=True)
+"""
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+from .tensor_dataset import TensorDataset, DEFAULT_CACHE_SIZE, ITEM_LIST_FIELD_NAMES
+from .hdf5_dataset import HDF5TensorDataset
+
+class TorchTensorDataset(Dataset):
+    """ Map-style torch dataset over a TensorDataset, keyed by global datapoint index.
+    Indexing with a list of indices returns a whole batch read with get_item_list,
+    which is the intended use together with ChunkBatchSampler and batch_size=None.
+
+    The TensorDataset is opened lazily in each process, so the adapter can be
+    pickled to DataLoader workers and every worker keeps its own tensor cache.
+    A path to an HDF5 file written by export_hdf5 is read with HDF5TensorDataset.
+    With local_cache_dir, the tensor files of a TensorDataset are staged to local disk.
+    """
+    def __init__(self, dataset_dir, field_names=None, cache_size=DEFAULT_CACHE_SIZE, local_cache_dir=None):
+        self._dataset_dir = dataset_dir
+        self._field_names = field_names
+        if field_names is None:
+            self._field_names = ITEM_LIST_FIELD_NAMES
+        self._cache_size = cache_size
+        self._local_cache_dir = local_cache_dir
+        self._dataset = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        return state
+
+    @property
+    def dataset(self):
+        """ Returns the underlying TensorDataset, opening it if necessary. """
+        if self._dataset is None:
+            if os.path.isfile(self._dataset_dir):
+                self._dataset = HDF5TensorDataset(self._dataset_dir, cache_size=self._cache_size)
+            else:
+                self._dataset = TensorDataset.open(self._dataset_dir, cache_size=self._cache_size,
+                                                   local_cache_dir=self._local_cache_dir)
+        return self._dataset
+
+    @property
+    def datapoints_per_file(self):
+        return self.dataset.datapoints_per_file
+
+    def __len__(self):
+        return self.dataset.num_datapoints
+
+    def __getitem__(self, indices):
+        """ Returns a dict of torch tensors for a single global index or a list of them. """
+        if np.isscalar(indices):
+            batch = self.dataset.get_item_list([indices], field_names=self._field_names)
+            return dict([(field_name, _to_torch(value)[0]) for field_name, value in batch.items()])
+        batch = self.dataset.get_item_list(indices, field_names=self._field_names)
+        return dict([(field_name, _to_torch(value)) for field_name, value in batch.items()])
+
+def _to_torch(value):
+    """ Wraps an array as a torch tensor, widening unsigned ints (e.g. obj_id) that torch does not support. """
+    if value.dtype.kind == 'u':
+        value = value.astype(np.int64)
+    return torch.from_numpy(np.ascontiguousarray(value))
+
+class ChunkBatchSampler(Sampler):
+    """ Yields batches of global indices that are shuffled at the granularity of tensor files:
+    the order of the files is shuffled, then the order of the datapoints within each file.
+
+    With num_workers > 0 the files are dealt out to one stream per worker and the batches
+    of the streams are interleaved, matching the round-robin order in which DataLoader
+    hands batches to its workers. Each worker then reads a disjoint set of files and
+    decompresses every file about once per epoch. The streams are balanced by number of
+    datapoints, and the few surplus batches of the longest streams are moved to the end
+    of the shortest ones so that every worker gets the same number of batches (up to one).
+    """
+    def __init__(self, indices, datapoints_per_file, batch_size, shuffle=True,
+                 drop_last=False, num_workers=0, seed=None):
+        """
+        Parameters
+        ----------
+        indices : :obj:`list` of int
+            global indices to sample from, e.g. the training indices of a split
+        datapoints_per_file : int
+            number of datapoints per tensor file of the dataset
+        batch_size : int
+            number of datapoints per batch
+        shuffle : bool
+            whether to shuffle files and datapoints, or keep the given order
+        drop_last : bool
+            whether to skip the last batch of each stream if it is smaller than batch_size
+        num_workers : int
+            number of DataLoader workers the batches are dealt out to
+        seed : int
+            seed for the shuffling, combined with the epoch number (None for the global RNG)
+        """
+        if batch_size <= 0:
+            raise ValueError('Batch size must be positive')
+        self._indices = np.asarray(indices, dtype=np.int64).ravel()
+        self._datapoints_per_file = datapoints_per_file
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._drop_last = drop_last
+        self._num_streams = max(num_workers, 1)
+        self._seed = seed
+        self._epoch = 0
+
+    def _stream_chunks(self):
+        """ Returns the indices of each tensor file, dealt out to one list per stream.
+        The assignment does not change between epochs, so persistent workers keep reading
+        the same files, and the streams are balanced by number of datapoints.
+        """
+        file_nums = self._indices // self._datapoints_per_file
+        order = np.argsort(file_nums, kind='mergesort')
+        _, starts = np.unique(file_nums[order], return_index=True)
+        chunks = np.split(self._indices[order], starts[1:])
+
+        streams = [[] for _ in range(self._num_streams)]
+        stream_sizes = np.zeros(self._num_streams, dtype=np.int64)
+        for chunk in chunks:
+            stream_num = np.argmin(stream_sizes)
+            streams[stream_num].append(chunk)
+            stream_sizes[stream_num] += chunk.shape[0]
+        return streams
+
+    def _num_batches(self, stream_size):
+        if self._drop_last:
+            return stream_size // self._batch_size
+        return -(-stream_size // self._batch_size)
+
+    def __len__(self):
+        return sum(self._num_batches(sum(chunk.shape[0] for chunk in chunks))
+                   for chunks in self._stream_chunks())
+
+    def __iter__(self):
+        random_state = np.random
+        if self._seed is not None:
+            random_state = np.random.RandomState(self._seed + self._epoch)
+        self._epoch += 1
+
+        stream_batches = []
+        for chunks in self._stream_chunks():
+            if self._shuffle:
+                random_state.shuffle(chunks)
+                for chunk in chunks:
+                    random_state.shuffle(chunk)
+            stream = np.concatenate(chunks) if len(chunks) > 0 else np.zeros(0, dtype=np.int64)
+            stream_batches.append([stream[i*self._batch_size: (i+1)*self._batch_size]
+                                   for i in range(self._num_batches(stream.shape[0]))])
+
+        # deal the surplus batches of the longest streams to the shortest ones, so that the streams
+        # differ by at most one batch and the longer streams come first. Otherwise, once a stream
+        # runs out, DataLoader hands the remaining batches of the other streams to the wrong workers
+        stream_batches.sort(key=len, reverse=True)
+        num_batches, num_longer = divmod(sum(len(batches) for batches in stream_batches), self._num_streams)
+        targets = [num_batches + 1 if stream_num < num_longer else num_batches for stream_num in range(self._num_streams)]
+        surplus = []
+        for batches, target in zip(stream_batches, targets):
+            while len(batches) > target:
+                surplus.append(batches.pop())
+        for batches, target in zip(stream_batches, targets):
+            while len(batches) < target:
+                batches.append(surplus.pop())
+
+        # interleave the streams in the order DataLoader assigns batches to workers
+        max_num_batches = max(len(batches) for batches in stream_batches)
+        for batch_num in range(max_num_batches):
+            for batches in stream_batches:
+                if batch_num < len(batches):
+                    yield batches[batch_num].tolist()